@@ -1,21 +1,23 @@
+from __future__ import annotations
+
 import astropy.units as u
 import copy
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pickle
 
-from astropy.table import Row
 from dataclasses import dataclass
+from typing import TYPE_CHECKING
 
 import adetsim.sim_src.AttenuationData as ad
 from adetsim.sim_src.FlareSpectrum import FlareSpectrum
 from adetsim.sim_src.DetectorStack import DetectorStack
 from adetsim.sim_src.Material import Material
 from adetsim.hafx_src.Sipm3000 import Sipm3000
-from .atmospheric_lookup_table import compute_lookup_table, ABUNDANCE_COLS
+from .atmospheric_lookup_table import compute_lookup_table, ABUNDANCE_COLS, plt
 
-plt.style.use(os.path.join(os.path.dirname(__file__), 'styles/plot.mplstyle'))
+if TYPE_CHECKING:
+    from astropy.table import Row
 
 
 EARTH_RADIUS = 6378 * u.km
@@ -99,11 +101,16 @@ class Layer():
 
         self.input_spectrum = input
         detector = DetectorStack([self.material], Sipm3000())
-        self.response = detector.generate_detector_response_to(input, disperse_energy=apply_energy_resolution)
-        self.output_spectrum = self.response @ input.flare
+        self.response_operator = detector.generate_response_operator(input, disperse_energy=apply_energy_resolution)
+        self.output_spectrum = self.response_operator @ input.flare
 
         return self.output_spectrum
 
+    @property
+    def response(self) -> np.ndarray:
+        ''' dense response matrix from the last attenuate_spectrum; response_operator avoids writing it out '''
+        return self.response_operator.toarray()
+
 
 @dataclass
 class Atmosphere():
@@ -3,16 +3,30 @@ Contains functions for generating and plotting the atmospheric lookup table usin
 This table contains the elemental abundances at each altitude.
 """
 
+from __future__ import annotations
+
 import astropy.units as u
 import itertools
-import matplotlib.pyplot as plt
 import numpy as np
 import os
+from typing import TYPE_CHECKING
+
+from adetsim.sim_src.LazyModule import LazyModule
+
+if TYPE_CHECKING:
+    from astropy.table import QTable
+
+
+def _use_style(pyplot):
+    pyplot.style.use(os.path.join(os.path.dirname(__file__), 'styles/plot.mplstyle'))
 
-from astropy.table import QTable
-from pymsis import msis
 
-plt.style.use(os.path.join(os.path.dirname(__file__), 'styles/plot.mplstyle'))
+# matplotlib only gets imported (and styled) once something is plotted
+plt = LazyModule('matplotlib.pyplot', on_load=_use_style)
+# only needed to compute a new lookup table
+msis = LazyModule('pymsis.msis')
+# astropy.table drags asdf in with it
+astropy_table = LazyModule('astropy.table')
 
 
 MARKERS = itertools.cycle(('x', '+', 'o', '*', 'v', 's', 'h', 'D'))
@@ -40,7 +54,7 @@ def _convert_msis_output_to_qtable(run_output: np.ndarray) -> QTable:
         'Temperature': u.Kelvin,
     }
 
-    table = QTable(run_output, names=columns.keys(), units=columns.values())
+    table = astropy_table.QTable(run_output, names=columns.keys(), units=columns.values())
     table['total mass density'] = table['total mass density'] << u.g / (u.cm**3)
     for c in table.columns:
         if c[-3:] == 'den':
@@ -1,21 +1,33 @@
 import numpy as np
-from .LinearInterpolateDisperseDetector import gaussian_row
+from .LinearInterpolateDisperseDetector import (
+    gaussian_row, gaussian_resolution_operator, DispersionMethod, DEFAULT_N_SIGMA)
 from ..sim_src import PhotonDetector
 from ..sim_src.FlareSpectrum import FlareSpectrum
+from ..sim_src.ResponseOperator import ResponseOperator
 
 class FixedEnergyResolutionDetector(PhotonDetector.PhotonDetector):
     # conservative estimate of energy resolution at 5.9 keV
     ERES = 0.03
+    # see LinearInterpolateDisperseDetector
+    dispersion_method = DispersionMethod.DEFAULT
+    n_sigma = DEFAULT_N_SIGMA
+    convolution_rtol = 1e-6
+
     def __init__(self, eres=ERES):
         super().__init__()
 
-    def generate_energy_resolution_given(self, spectrum: FlareSpectrum) -> np.ndarray:
+    @property
+    def resolution_parameters(self) -> tuple:
+        return (float(self.ERES),)
+
+    def index_fwhm(self, spectrum: FlareSpectrum) -> np.ndarray:
         de = np.diff(spectrum.energy_edges)
         midpoints = spectrum.energy_edges[:-1] + de/2
-        fwhm = self.ERES * midpoints / de
+        return self.ERES * midpoints / de
 
+    def _build_energy_resolution(self, spectrum: FlareSpectrum) -> np.ndarray:
         dim = spectrum.energy_edges.size - 1
-        idxs = np.arange(dim)
-        vec_idxs = np.tile(idxs, (dim, 1)).transpose()
+        return gaussian_row(dim, self.index_fwhm(spectrum), np.arange(dim)[:, None])
 
-        return gaussian_row(dim, fwhm, vec_idxs)
+    def energy_resolution_operator(self, spectrum: FlareSpectrum) -> ResponseOperator:
+        return gaussian_resolution_operator(self, spectrum)
@@ -2,8 +2,12 @@ import numpy as np
 import os
 
 from ..sim_src.FlareSpectrum import FlareSpectrum
+from ..sim_src.ResponseLibrary import ResponseLibrary
+from ..sim_src.ResponseOperator import DiagonalResponse
+from ..sim_src import attenuator_search, folding
 from .HafxStack import HafxStack
 from .HafxMaterialProperties import SINGLE_DET_AREA
+from .LinearInterpolateDisperseDetector import LinearInterpolateDisperseDetector
 
 class HafxSimulationContainer:
     MIN_ENG = 1.0               # keV
@@ -26,8 +30,12 @@ class HafxSimulationContainer:
     KPURE_RESPONSE = 'pure_response_matrix'
     KDISPERSED_RESPONSE = 'dispersed_response_matrix'
     MATRIX_KEYS = (KDISPERSED_RESPONSE, KPURE_RESPONSE)
+    # compact files keep these instead of the matrices
+    KPURE_DIAGONAL = 'pure_response_diagonal'
+    KRESOLUTION = 'resolution_parameters'
 
     DEFAULT_SAVE_DIR = 'responses-and-areas'
+    LIBRARY_DETECTOR = 'hafx'
 
     @classmethod
     def from_file(cls, filename:str, remake_spectrum=False):
@@ -36,7 +44,10 @@ class HafxSimulationContainer:
 
     @classmethod
     def from_saved_file(cls, filename: str, remake_spectrum=False):
-        ''' load the container from a (compressed) .npz file '''
+        '''
+        load the container from a .npz file written by `save_to_file`.
+        compact files get their matrices back as lazy operators.
+        '''
         data = np.load(filename, allow_pickle=True)
         goes_class = str(data[cls.KGOES_CLASS])
 
@@ -56,10 +67,52 @@ class HafxSimulationContainer:
             )
 
         ret = cls(aluminum_thickness=data[cls.KAL_THICKNESS], flare_spectrum=fs)
+        if cls.KPURE_DIAGONAL in data:
+            ret._restore_compact(data[cls.KPURE_DIAGONAL], tuple(data[cls.KRESOLUTION]))
+            return ret
         for k in cls.MATRIX_KEYS:
             ret.matrices[k] = data[k]
         return ret
 
+    def _restore_compact(self, pure_diagonal: np.ndarray, resolution_parameters: tuple):
+        ''' rebuild the responses from the stored diagonal and energy resolution '''
+        detector = self.detector_stack.photon_detector
+        if resolution_parameters != detector.resolution_parameters:
+            self.detector_stack.photon_detector = \
+                LinearInterpolateDisperseDetector.from_resolution_parameters(resolution_parameters)
+        pure = DiagonalResponse(pure_diagonal)
+        self.matrices[self.KPURE_RESPONSE] = pure
+        self.matrices[self.KDISPERSED_RESPONSE] = \
+            self.detector_stack.apply_detector_dispersion_for(self.flare_spectrum, pure)
+
+    @classmethod
+    def from_library(cls, library, goes_class: str, aluminum_thickness: np.float64):
+        '''
+        load the container from a ResponseLibrary (or the path to one).
+        the response matrices are memory mapped, not read, so only what gets used is loaded.
+        '''
+        library = library if isinstance(library, ResponseLibrary) else ResponseLibrary(library)
+        entry = library[goes_class, aluminum_thickness, cls.LIBRARY_DETECTOR]
+        fs = FlareSpectrum(
+            goes_class=goes_class,
+            thermal=entry[cls.KFLARE_THERMAL],
+            nonthermal=entry[cls.KFLARE_NONTHERMAL],
+            energy_edges=entry[cls.KENERGY_EDGES]
+        )
+        ret = cls(aluminum_thickness=entry.thickness, flare_spectrum=fs)
+        for k in cls.MATRIX_KEYS:
+            ret.matrices[k] = entry[k]
+        return ret
+
+    @classmethod
+    def all_from_library(cls, library) -> list:
+        ''' every HaFX container in a ResponseLibrary (or the path to one) '''
+        library = library if isinstance(library, ResponseLibrary) else ResponseLibrary(library)
+        return [
+            cls.from_library(library, goes_class, thickness)
+            for (goes_class, thickness, _) in library.find(detector=cls.LIBRARY_DETECTOR)
+        ]
+
     def __init__(self, aluminum_thickness: np.float64=None, flare_spectrum: FlareSpectrum=None):
         self.detector_stack = HafxStack()
         self.al_thick = aluminum_thickness
@@ -82,16 +135,9 @@ class HafxSimulationContainer:
     def compute_effective_area(self, cps_threshold: np.int64=0, different_flare: FlareSpectrum=None):
         fspec_of_interest = different_flare or self.flare_spectrum
         if cps_threshold > 0:
-            restrict = np.logical_and(
-                    fspec_of_interest.energy_edges >= self.MIN_THRESHOLD_ENG,
-                    fspec_of_interest.energy_edges <= self.MAX_THRESHOLD_ENG)
-            try:
-                dispersed_flare = np.matmul(self.matrices[self.KDISPERSED_RESPONSE], fspec_of_interest.flare)
-            except ValueError:
-                print(self.matrices[self.KDISPERSED_RESPONSE])
-                raise
-            bin_widths = np.diff(fspec_of_interest.energy_edges[restrict])
-            relevant_cps = np.sum(dispersed_flare[restrict[:-1]] * SINGLE_DET_AREA * bin_widths)
+            (_, (relevant_cps,)) = self.fold_spectra(
+                fspec_of_interest.flare, bands=[(self.MIN_THRESHOLD_ENG, self.MAX_THRESHOLD_ENG)],
+                keep_counts=False, energy_edges=fspec_of_interest.energy_edges)
 
             # "set" effective area to zero if we get more than the threshold counts
             if relevant_cps > cps_threshold:
@@ -101,15 +147,49 @@ class HafxSimulationContainer:
         att_area = self.matrices[self.KPURE_RESPONSE] @ area_vector
         return att_area
 
+    @classmethod
+    def minimal_attenuator_thicknesses(
+            cls, goes_classes: list, cps_threshold: np.float64,
+            energy_edges: np.ndarray=None, **kwargs) -> dict:
+        '''
+        thinnest Al attenuator (cm) for each GOES class which keeps the counts between
+        MIN_THRESHOLD_ENG and MAX_THRESHOLD_ENG at or under cps_threshold for one detector,
+        i.e. the thickness where `compute_effective_area` stops zeroing the area.
+        energy_edges default to MIN_ENG to MAX_ENG in steps of DE.
+        see `attenuator_search.minimal_thicknesses` for the other options.
+        '''
+        if energy_edges is None:
+            energy_edges = np.arange(cls.MIN_ENG, cls.MAX_ENG + cls.DE / 2, cls.DE)
+        flares = [FlareSpectrum.make_with_battaglia_scaling(gc, energy_edges) for gc in goes_classes]
+        thicknesses = attenuator_search.minimal_thicknesses(
+            HafxStack(), flares, cps_threshold,
+            band=(cls.MIN_THRESHOLD_ENG, cls.MAX_THRESHOLD_ENG), area=SINGLE_DET_AREA, **kwargs)
+        return dict(zip(goes_classes, thicknesses))
+
+    def fold_spectra(
+            self, spectra: np.ndarray, bands=(), dispersed: bool=True,
+            energy_edges: np.ndarray=None, **kwargs) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        fold a (T, N) block of spectra (e.g. a light curve) through the simulated response.
+        band rates come out in counts/s for one detector (SINGLE_DET_AREA).
+        see `folding.fold_spectra` for the other options.
+        '''
+        key = self.KDISPERSED_RESPONSE if dispersed else self.KPURE_RESPONSE
+        if self.matrices[key] is None:
+            raise ValueError("Matrices haven't been computed; run simulate() first.")
+        edges = self.flare_spectrum.energy_edges if energy_edges is None else energy_edges
+        return folding.fold_spectra(
+            self.matrices[key], spectra, edges, bands, area=SINGLE_DET_AREA, **kwargs)
+
     def simulate(self, other_spectrum: FlareSpectrum=None):
         fs = other_spectrum or self.flare_spectrum
         if self.al_thick is None:
             raise ValueError("Aluminum thickness has not been set.")
-        # get the un-dispersed (pure) response matrix
+        # get the un-dispersed (pure) response; a lazy operator, not a dense matrix
         self.matrices[self.KPURE_RESPONSE] =\
                 self \
                 .detector_stack \
-                .generate_detector_response_to(fs, False) \
+                .generate_response_operator(fs, False)
         # apply CeBr3 energy resolution
         self.matrices[self.KDISPERSED_RESPONSE] =\
                 self \
@@ -120,8 +200,13 @@ class HafxSimulationContainer:
         gc = self.flare_spectrum.goes_class
         return f"{prefix or 'no_prefix'}_{gc or 'no_goes'}_{self.al_thick:.3e}cm_hafx"
 
-    def save_to_file(self, out_dir=DEFAULT_SAVE_DIR, prefix=None):
-        ''' save object data into a file that can be loaded back in later '''
+    def save_to_file(self, out_dir=DEFAULT_SAVE_DIR, prefix=None, compact: bool=False):
+        '''
+        save object data into a file that can be loaded back in later.
+        compact: instead of both dense N x N matrices, keep the diagonal of the
+            pure response and the detector resolution parameters; the dispersed
+            response is rebuilt from them on load. (2990 bins: ~100 kB instead of ~140 MB)
+        '''
         if not os.path.exists(out_dir):
             os.mkdir(out_dir)
         if None in self.matrices:
@@ -137,8 +222,47 @@ class HafxSimulationContainer:
         to_save[self.KFLARE_NONTHERMAL] = self.flare_spectrum.nonthermal
         to_save[self.KENERGY_EDGES] = self.flare_spectrum.energy_edges
 
-        for k in self.MATRIX_KEYS:
-            to_save[k] = self.matrices[k]
         outfn = os.path.join(out_dir, self.gen_file_name(prefix))
+        if compact:
+            to_save[self.KPURE_DIAGONAL] = self.pure_response_diagonal()
+            to_save[self.KRESOLUTION] = np.array(self.detector_stack.photon_detector.resolution_parameters)
+            np.savez(outfn, **to_save)
+            return
+
+        for k in self.MATRIX_KEYS:
+            to_save[k] = np.asarray(self.matrices[k])
         np.savez_compressed(outfn, **to_save)
 
+    def pure_response_diagonal(self) -> np.ndarray:
+        ''' the pure (un-dispersed) response is diagonal: transmission times scintillator absorption '''
+        pure = self.matrices[self.KPURE_RESPONSE]
+        if isinstance(pure, DiagonalResponse):
+            return pure.diagonal
+        pure = np.asarray(pure)
+        diagonal = np.diag(pure)
+        if np.count_nonzero(pure - np.diag(diagonal)):
+            raise ValueError("The pure response isn't diagonal, so it can't be saved compactly.")
+        return diagonal
+
+    def save_to_library(self, library=DEFAULT_SAVE_DIR, overwrite: bool=False):
+        '''
+        save object data into a ResponseLibrary (or a directory to make one in):
+        uncompressed .npy blocks that `from_library` memory maps back in.
+        '''
+        library = library if isinstance(library, ResponseLibrary) else ResponseLibrary(library)
+        if any(self.matrices[k] is None for k in self.MATRIX_KEYS):
+            raise ValueError("Matrices haven't been computed so we can't save them.")
+        if self.flare_spectrum is None:
+            raise ValueError("Stored FlareSpectrum is None--simulation probably hasn't run.")
+
+        arrays = {
+            self.KENERGY_EDGES: self.flare_spectrum.energy_edges,
+            self.KFLARE_THERMAL: self.flare_spectrum.thermal,
+            self.KFLARE_NONTHERMAL: self.flare_spectrum.nonthermal,
+        }
+        for k in self.MATRIX_KEYS:
+            arrays[k] = np.asarray(self.matrices[k])
+        return library.add(
+            self.flare_spectrum.goes_class, self.al_thick, self.LIBRARY_DETECTOR,
+            arrays, overwrite=overwrite)
+
@@ -4,6 +4,7 @@ from ..sim_src.AttenuationData import AttenuationData, AttenuationType
 from ..sim_src.DetectorStack import DetectorStack
 from ..sim_src.FlareSpectrum import FlareSpectrum
 from ..sim_src.Material import Material
+from ..sim_src.ResponseOperator import ResponseOperator, DiagonalResponse
 
 from .HafxMaterialProperties import \
     HAFX_MATERIAL_ORDER, AL, THICKNESSES, \
@@ -40,19 +41,21 @@ class HafxStack(DetectorStack):
     def att_thick(self, new):
         self.materials[0].thickness = new
 
-    def generate_detector_response_to(
-            self, incident_spectrum: FlareSpectrum, disperse_energy: bool, chosen_attenuations: list=AttenuationType.ALL) -> np.ndarray:
-        response = self._generate_material_response_due_to(incident_spectrum, chosen_attenuations)
+    def generate_response_operator(
+            self, incident_spectrum: FlareSpectrum, disperse_energy: bool, chosen_attenuations: list=AttenuationType.ALL) -> ResponseOperator:
+        response = DiagonalResponse(self._generate_material_transmission(incident_spectrum, chosen_attenuations))
         if self.enable_scintillator:
             # now incorporate the scintillator
-            absorbed = self.generate_scintillator_response(incident_spectrum, chosen_attenuations)
+            absorbed = DiagonalResponse(self._scintillator_absorption(incident_spectrum, chosen_attenuations))
             response = absorbed @ response
         return self._dispatch_dispersion(incident_spectrum, response, disperse_energy)
 
     def generate_scintillator_response(self, incident_spectrum: FlareSpectrum, chosen_attenuations: list) -> np.ndarray:
+        return np.diag(self._scintillator_absorption(incident_spectrum, chosen_attenuations))
+
+    def _scintillator_absorption(self, incident_spectrum: FlareSpectrum, chosen_attenuations: list) -> np.ndarray:
         onez = np.ones(incident_spectrum.energy_edges.size - 1)
         # we must include photoelectric absorption as this mechanism leads to scintillation.
-        abs_atts = list(set([AttenuationType.PHOTOELECTRIC_ABSORPTION] + chosen_attenuations))
+        abs_atts = list(set([AttenuationType.PHOTOELECTRIC_ABSORPTION] + list(chosen_attenuations)))
         # XXX: only dimensions of incident_spectrum used in this call. confusing...
-        absorbed = onez - self.scintillator.generate_overall_response_matrix_given(incident_spectrum, abs_atts)
-        return np.diag(absorbed)
+        return onez - self.scintillator.generate_overall_response_matrix_given(incident_spectrum, abs_atts)
@@ -1,14 +1,50 @@
 import numpy as np
+from scipy import sparse
 from ..sim_src.PhotonDetector import PhotonDetector
 from ..sim_src.FlareSpectrum import FlareSpectrum
+from ..sim_src.LazyModule import LazyModule
+from ..sim_src.ResponseOperator import ResponseOperator, BandedResponse, DenseResponse
+
+# scipy.signal takes long to import and only the convolution method needs it
+signal = LazyModule('scipy.signal')
+
+# a Gaussian loses erfc(8 / sqrt(2)) ~ 1e-15 of its area past 8 sigma
+DEFAULT_N_SIGMA = 8
+
+class DispersionMethod:
+    ''' how `energy_resolution_operator` represents a Gaussian energy resolution '''
+    DENSE = 'dense'
+    BANDED = 'banded'
+    CONVOLUTION = 'convolution'
+    ALL = [DENSE, BANDED, CONVOLUTION]
+    DEFAULT = BANDED
 
 class LinearInterpolateDisperseDetector(PhotonDetector):
+    dispersion_method = DispersionMethod.DEFAULT
+    # Gaussians get cut off this many sigma from their center (banded and convolution methods)
+    n_sigma = DEFAULT_N_SIGMA
+    # error the convolution method aims for; see GaussianConvolutionResponse
+    convolution_rtol = 1e-6
+
     def __init__(self, e1, e2, fwhm1, fwhm2):
         self.min_fwhm = min(fwhm1, fwhm2)
         self.slope = (fwhm2 - fwhm1) / (e2 - e1)
         self.intercept = fwhm1 - self.slope*e1
         super().__init__()
 
+    @classmethod
+    def from_resolution_parameters(cls, parameters: tuple) -> 'LinearInterpolateDisperseDetector':
+        ''' detector with the given (slope, intercept) resolution line, e.g. read back from a file '''
+        slope, intercept = parameters
+        ret = LinearInterpolateDisperseDetector(0, 1, intercept, intercept + slope)
+        # exactly, not recomputed from two points
+        ret.slope, ret.intercept = float(slope), float(intercept)
+        return ret
+
+    @property
+    def resolution_parameters(self) -> tuple:
+        return (float(self.slope), float(self.intercept))
+
     def interpolate_energy_resolution(self, energies: np.ndarray) -> np.ndarray:
         ''' put a line through two points that we know '''
         ret = self.slope*energies + self.intercept
@@ -19,17 +55,40 @@ class LinearInterpolateDisperseDetector(PhotonDetector):
             print('asdf')
         return ret
 
-    def generate_energy_resolution_given(self, incident_spectrum: FlareSpectrum) -> np.ndarray:
+    def index_fwhm(self, incident_spectrum: FlareSpectrum) -> np.ndarray:
+        ''' energy resolution (FWHM) at each bin, in units of bins '''
         bin_widths = np.diff(incident_spectrum.energy_edges)
         midpoints = incident_spectrum.energy_edges[:-1] + bin_widths/2
         resolutions = self.interpolate_energy_resolution(midpoints)
         # convert the energy fwhm to "index" space
-        fwhm = resolutions * midpoints / bin_widths
+        return resolutions * midpoints / bin_widths
 
+    def _build_energy_resolution(self, incident_spectrum: FlareSpectrum) -> np.ndarray:
         dim = incident_spectrum.energy_edges.size - 1
-        rng = np.arange(dim)
-        vectorized_indices = np.tile(rng, (dim, 1)).transpose()
-        return gaussian_row(dim, fwhm, vectorized_indices)
+        return gaussian_row(dim, self.index_fwhm(incident_spectrum), np.arange(dim)[:, None])
+
+    def energy_resolution_operator(self, incident_spectrum: FlareSpectrum) -> ResponseOperator:
+        return gaussian_resolution_operator(self, incident_spectrum)
+
+
+def gaussian_resolution_operator(detector: PhotonDetector, incident_spectrum: FlareSpectrum) -> ResponseOperator:
+    '''
+    energy_resolution_operator for a detector whose resolution is gaussian_row of
+    its `index_fwhm`, in the representation its `dispersion_method` asks for.
+    '''
+    method = detector.dispersion_method
+    dim = incident_spectrum.energy_edges.size - 1
+    if method == DispersionMethod.DENSE:
+        return DenseResponse(detector.generate_energy_resolution_given(incident_spectrum))
+    if method == DispersionMethod.BANDED:
+        band = detector._cached_resolution(
+            ('banded', detector.n_sigma), incident_spectrum,
+            lambda: gaussian_band(dim, detector.index_fwhm(incident_spectrum), detector.n_sigma))
+        return BandedResponse(band)
+    if method == DispersionMethod.CONVOLUTION:
+        return GaussianConvolutionResponse(
+            detector.index_fwhm(incident_spectrum), detector.n_sigma, detector.convolution_rtol)
+    raise ValueError(f'unknown dispersion method {method!r}; pick from {DispersionMethod.ALL}')
 
 
 def gaussian_row(dim, fwhm, idx):
@@ -38,3 +97,161 @@ def gaussian_row(dim, fwhm, idx):
     prefac = 1 / (sd * np.sqrt(2 * np.pi))
     exponent = -(space - idx)**2 / (2 * sd*sd)
     return  prefac * np.exp(exponent)
+
+
+def gaussian_band(dim, fwhm, n_sigma=DEFAULT_N_SIGMA) -> sparse.csr_matrix:
+    '''
+    Same entries as gaussian_row(dim, fwhm, <row index column>), but column j
+    (true energy bin j, width fwhm[j]) only keeps the rows within
+    n_sigma standard deviations of j. Only the band is ever allocated.
+    '''
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=np.float64), (dim,))
+    sd = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    cols = np.arange(dim)
+    first = np.clip(np.ceil(cols - n_sigma*sd), 0, dim - 1).astype(np.int64)
+    last = np.clip(np.floor(cols + n_sigma*sd), 0, dim - 1).astype(np.int64)
+    counts = last - first + 1
+
+    # column j holds rows first[j], first[j] + 1, ..., last[j]: build it column-wise
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    index_type = np.int32 if indptr[-1] < np.iinfo(np.int32).max else np.int64
+    rows = np.empty(indptr[-1], dtype=index_type)
+    values = np.empty(indptr[-1])
+    # fill a few million entries at a time so the temporaries stay small
+    chunk_cols = max(1, int(2**22 * dim / max(indptr[-1], 1)))
+    for start in range(0, dim, chunk_cols):
+        stop = min(start + chunk_cols, dim)
+        (a, b) = (indptr[start], indptr[stop])
+        n = counts[start:stop]
+        distance = np.arange(a, b) + np.repeat(first[start:stop] - indptr[start:stop] - cols[start:stop], n)
+        rows[a:b] = distance + np.repeat(cols[start:stop], n)
+        col_sd = np.repeat(sd[start:stop], n)
+        values[a:b] = _gaussian(distance, col_sd)
+    return sparse.csc_matrix((values, rows, indptr), shape=(dim, dim)).tocsr()
+
+
+def _gaussian(distance, sd):
+    ''' same formula as gaussian_row '''
+    return np.exp(-distance**2 / (2 * sd*sd)) / (sd * np.sqrt(2 * np.pi))
+
+
+class GaussianConvolutionResponse(ResponseOperator):
+    '''
+    Matrix-free gaussian_row(dim, fwhm, <row index column>): applies the
+    dispersion with FFT convolutions and never stores anything N x N.
+
+    In index space column j is a Gaussian of width sd[j] centered on j.
+    The widths get put on "levels" spaced evenly by h in log(sd), and each
+    level is one stationary kernel. Column j's Gaussian is replaced by the
+    linear interpolation (in log sd) of the kernels of the levels on either side.
+    So a spectrum is split into one weighted block of energies per level, each
+    block is convolved with its level's kernel, and the results are added up
+    (overlap-add): about sum of (block + kernel) * log(block + kernel) work.
+
+    Error: for continuous Gaussians, interpolating between widths h apart in
+    log(sd) is worst halfway, where the L1 error of a column is
+        h**2 / 8 * E|Z**4 - 4 Z**2 + 1| = 0.229 h**2   (Z standard normal)
+    and h is picked to make this `rtol`. `error_bound` evaluates that error
+    on the sampled grid, against the untruncated gaussian_row column, halfway
+    between every pair of levels in use and returns the largest. That is
+    the matrix 1-norm of (exact - this), so for any spectrum x
+        sum |exact @ x - self @ x| <= error_bound * sum |x|.
+    Uniform fine grids, where the resolution changes slowly across bins, need few levels.
+    '''
+    # E|Z**4 - 4 Z**2 + 1|
+    INTERPOLATION_CONSTANT = 1.8321
+
+    def __init__(self, fwhm: np.ndarray, n_sigma: float=DEFAULT_N_SIGMA, rtol: float=1e-6):
+        self.sd = np.asarray(fwhm, dtype=np.float64) / (2 * np.sqrt(2 * np.log(2)))
+        self.n_sigma = n_sigma
+        self.rtol = rtol
+        self.transposed = False
+
+        log_sd = np.log(self.sd)
+        (lo, hi) = (log_sd.min(), log_sd.max())
+        step = np.sqrt(8 * rtol / self.INTERPOLATION_CONSTANT)
+        num_intervals = max(1, int(np.ceil((hi - lo) / step)))
+        self.level_sd = np.exp(np.linspace(lo, hi, num_intervals + 1))
+
+        position = (log_sd - lo) * (num_intervals / (hi - lo)) if hi > lo else np.zeros_like(log_sd)
+        interval = np.clip(np.floor(position).astype(np.int64), 0, num_intervals - 1)
+        frac = position - interval
+        # (level, first column, weights of the columns from there on)
+        self._blocks = list(_level_blocks(interval, frac))
+
+    @property
+    def shape(self):
+        return (self.sd.size, self.sd.size)
+
+    @property
+    def T(self):
+        ret = object.__new__(GaussianConvolutionResponse)
+        ret.__dict__.update(self.__dict__)
+        ret.transposed = not self.transposed
+        return ret
+
+    def _kernel(self, level: int) -> tuple[int, np.ndarray]:
+        sd = self.level_sd[level]
+        half_width = int(np.ceil(self.n_sigma * sd))
+        return half_width, _gaussian(np.arange(-half_width, half_width + 1, dtype=np.float64), sd)
+
+    def apply(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        dim = self.sd.size
+        ret = np.zeros_like(x)
+        for (level, first, weights) in self._blocks:
+            (half_width, kernel) = self._kernel(level)
+            if x.ndim == 2:
+                (kernel, weights) = (kernel[:, None], weights[:, None])
+            last = first + weights.shape[0]
+            (a, b) = (max(first - half_width, 0), min(last + half_width, dim))
+            if not self.transposed:
+                # spread the weighted block out. conv[t] lands on row (first - half_width + t)
+                conv = signal.fftconvolve(weights * x[first:last], kernel, axes=0)
+                offset = first - half_width
+                ret[a:b] += conv[a - offset:b - offset]
+            else:
+                # gather what each column of the block spreads into (the kernel is symmetric)
+                conv = signal.fftconvolve(x[a:b], kernel, axes=0)
+                offset = half_width - a
+                ret[first:last] += weights * conv[first + offset:last + offset]
+        return ret
+
+    @property
+    def error_bound(self) -> float:
+        ''' largest L1 error of any column against gaussian_row; see the class docstring '''
+        levels = sorted(set(level for (level, _, _) in self._blocks))
+        pairs = [(m, m + 1) for m in levels if m + 1 in levels] or [(levels[0], levels[0])]
+        worst = 0.0
+        for (m, n) in pairs:
+            (sd_lo, sd_hi) = (self.level_sd[m], self.level_sd[n])
+            sd = np.sqrt(sd_lo * sd_hi)
+            reach = int(np.ceil(max(self.n_sigma, 40) * sd_hi)) + 1
+            distance = np.arange(-reach, reach + 1, dtype=np.float64)
+            approx = np.zeros_like(distance)
+            for level in (m, n):
+                (half_width, kernel) = self._kernel(level)
+                approx[reach - half_width:reach + half_width + 1] += kernel / 2
+            worst = max(worst, np.abs(_gaussian(distance, sd) - approx).sum())
+        return float(worst)
+
+
+def _level_blocks(interval: np.ndarray, frac: np.ndarray):
+    '''
+    for linear interpolation between levels, yield (level, first column, weights)
+    where weights covers the columns from the first to the last one with a nonzero weight.
+    column j has weight 1 - frac[j] on level interval[j] and frac[j] on the level above.
+    '''
+    order = np.argsort(interval, kind='stable')
+    bounds = np.searchsorted(interval[order], np.arange(interval.max() + 2))
+    for level in range(interval.max() + 2):
+        lower = order[bounds[level - 1]:bounds[level]] if level > 0 else order[:0]
+        upper = order[bounds[level]:bounds[level + 1]] if level <= interval.max() else order[:0]
+        cols = np.concatenate((lower, upper))
+        if cols.size == 0:
+            continue
+        (first, last) = (cols.min(), cols.max() + 1)
+        weights = np.zeros(last - first)
+        weights[upper - first] = 1 - frac[upper]
+        weights[lower - first] = frac[lower]
+        yield level, first, weights
@@ -5,6 +5,7 @@ from ..sim_src.AttenuationData import AttenuationType, AttenuationData
 from ..sim_src.DetectorStack import DetectorStack
 from ..sim_src.FlareSpectrum import FlareSpectrum
 from ..sim_src.Material import Material
+from ..sim_src.ResponseOperator import ResponseOperator, DiagonalResponse
 
 from . import HafxMaterialProperties as hmp
 from .FixedEnergyResolutionDetector import FixedEnergyResolutionDetector
@@ -33,11 +34,11 @@ class X123Stack(DetectorStack):
                 hmp.ATTEN_FORMULAS[hmp.SI]))
         super().__init__(materials, FixedEnergyResolutionDetector())
 
-    def generate_detector_response_to(
+    def generate_response_operator(
             self, spectrum: FlareSpectrum, disperse_energy: bool,
-            chosen_attenuations: tuple=AttenuationType.ALL) -> np.ndarray:
-        prelim_resp = self._generate_material_response_due_to(spectrum, chosen_attenuations)
+            chosen_attenuations: tuple=AttenuationType.ALL) -> ResponseOperator:
+        prelim_resp = self._generate_material_transmission(spectrum, chosen_attenuations)
         abzorbed = np.ones(spectrum.energy_edges.size - 1) -\
             self.detector_volume.generate_overall_response_matrix_given(
                 spectrum, [AttenuationType.PHOTOELECTRIC_ABSORPTION])
-        return self._dispatch_dispersion(spectrum, abzorbed * prelim_resp, disperse_energy)
+        return self._dispatch_dispersion(spectrum, DiagonalResponse(abzorbed * prelim_resp), disperse_energy)
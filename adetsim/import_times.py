@@ -0,0 +1,83 @@
+'''
+How long each public adetsim module takes to import, each in a fresh interpreter,
+and which of the heavy optional dependencies got imported along with it.
+
+    python -m adetsim.import_times
+    python -m adetsim.import_times --repeat 5 --budget 1.5 adetsim.sim_src.FlareSpectrum
+
+Exits with 1 if any module takes longer than --budget seconds or fails to import,
+so it can run as a check.
+'''
+import argparse
+import json
+import pkgutil
+import subprocess
+import sys
+
+import adetsim
+
+# these should only get imported when something actually needs them
+HEAVY = ('sunkit_spex', 'matplotlib', 'pymsis', 'asdf', 'requests')
+
+_PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+print(json.dumps([dt, sorted(m for m in {heavy!r} if m in sys.modules)]))
+'''
+
+
+def public_modules() -> list:
+    ''' adetsim modules without a leading underscore anywhere in their name '''
+    return sorted(
+        m.name for m in pkgutil.walk_packages(adetsim.__path__, prefix='adetsim.')
+        if not any(part.startswith('_') for part in m.name.split('.'))
+        and m.name != 'adetsim.import_times'
+    )
+
+
+def time_import(module: str, repeat: int=3) -> tuple:
+    '''
+    best import time (s) of `module` over `repeat` fresh interpreters,
+    and the heavy dependencies it pulled in.
+    '''
+    best, heavy = float('inf'), []
+    for _ in range(repeat):
+        res = subprocess.run(
+            [sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY)],
+            capture_output=True, text=True)
+        if res.returncode != 0:
+            lines = res.stderr.strip().splitlines()
+            raise ImportError(lines[-1] if lines else f'{module} failed to import')
+        dt, heavy = json.loads(res.stdout.strip().splitlines()[-1])
+        best = min(best, dt)
+    return best, heavy
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', help='modules to time (default: every public module)')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per module; the best time is kept')
+    parser.add_argument('--budget', type=float, default=None, help='seconds any one import may take')
+    args = parser.parse_args(argv)
+
+    modules = args.modules or public_modules()
+    width = max(len(m) for m in modules)
+    failed = False
+    print(f'{"module":<{width}}  {"import (s)":>10}  heavy dependencies loaded')
+    for m in modules:
+        try:
+            dt, heavy = time_import(m, args.repeat)
+        except ImportError as e:
+            print(f'{m:<{width}}  {"failed":>10}  {e}')
+            failed = True
+            continue
+        over = args.budget is not None and dt > args.budget
+        failed |= over
+        print(f'{m:<{width}}  {dt:>10.3f}  {", ".join(heavy) or "-"}{"  OVER BUDGET" if over else ""}')
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,16 @@
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import warnings
+
 import astropy.units as u
 import numpy as np
-from scipy import interpolate
 
 from . import material_manager as mman
+from . import transmission
+from .caching import LruCache, atomic_write, key_digest, user_cache_dir
 
 class AttenuationType:
     PHOTOELECTRIC_ABSORPTION = 1
@@ -20,12 +28,83 @@ class AttenuationType:
         }
 
 class AttenuationData:
+    # how closely the merged compound tables follow the sum over elements
+    MERGE_RTOL = 1e-10
+    MAX_MERGE_REFINEMENTS = transmission.MAX_TABLE_REFINEMENTS
+
+    # shared instances, keyed by normalized compound formula and element data digests
+    cache = LruCache(max_entries=64)
+    # tells apart instances without a formula in response caches; unlike id() never reused
+    _instance_numbers = itertools.count()
+
+    # merged tables kept on disk across processes (see `disk_cache_file`); None turns that off
+    DISK_CACHE_PATH = user_cache_dir('compounds')
+    # least recently used tables get removed while the folder holds more than this
+    DISK_CACHE_MAX_BYTES = 64 * 2**20
+    # folders we couldn't save to; only warned about once
+    _unwritable_folders = set()
+    DISK_MAGIC = b'ADETCMP1'
+
     @classmethod
-    def from_compound_dict(cls, compound: dict[str, float]):
+    def from_compound_dict(cls, compound: dict[str, float], use_cache: bool=True, use_disk: bool=True):
         '''
         Construct an AttenuationData using the same compound format as
         in `material_manager`.
+        With use_cache, every call with the same (normalized) formula gets the
+        same read-only instance back, so the data is only loaded once per process.
+        With use_disk (and DISK_CACHE_PATH set), the merged tables are saved the first
+        time a compound is built, and memory mapped from then on instead of loading
+        and merging the elements again.
+        Refreshed element data gets loaded and merged again, both in memory and on disk.
+        '''
+        if not use_cache:
+            return cls._load_compound(compound, use_disk)
+        formula_key = mman.normalize_formula(compound)
+        key = (formula_key, cls.source_digests(formula_key))
+        return cls.cache.get_or_compute(key, lambda: cls._load_compound(compound, use_disk))
+
+    @staticmethod
+    def source_digests(formula_key: tuple) -> tuple:
+        '''
+        `mman.element_source_digest` of each element of a normalized formula;
+        elements without local data get downloaded
         '''
+        return tuple(mman.element_source_digest(element, fetch=True) for (element, _) in formula_key)
+
+    @classmethod
+    def _load_compound(cls, compound: dict[str, float], use_disk: bool=True):
+        key = mman.normalize_formula(compound)
+        use_disk = use_disk and cls.DISK_CACHE_PATH is not None
+        path = cls.disk_cache_file(key) if use_disk else None
+        ret = None
+        if path is not None and os.path.exists(path):
+            try:
+                ret = cls.load(path)
+            except ValueError as e:
+                warnings.warn(f'rebuilding compound table {path}: {e}')
+            else:
+                # recently used tables are the last to go when the folder gets trimmed
+                with contextlib.suppress(OSError):
+                    os.utime(path)
+        if ret is None:
+            ret = cls._merge_compound(compound)
+            if path is not None:
+                try:
+                    cls._store(ret, path)
+                except OSError as e:
+                    folder = os.path.dirname(path)
+                    if folder not in cls._unwritable_folders:
+                        cls._unwritable_folders.add(folder)
+                        warnings.warn(
+                            f'could not save compound tables in {folder} ({e.strerror}); '
+                            f'set AttenuationData.DISK_CACHE_PATH = None to stop trying')
+        ret.formula_key = key
+        ret.source_key = cls.source_digests(key)
+        ret.freeze()
+        return ret
+
+    @classmethod
+    def _merge_compound(cls, compound: dict[str, float]):
         weighted_coeffs = mman.fetch_compound(compound)
         for (name, coeffs) in weighted_coeffs.items():
             clean = {
@@ -34,14 +113,119 @@ class AttenuationData:
             for k in ('rayleigh', 'compton', 'photoelectric'):
                 clean[k] = coeffs[k].to_value(u.cm**2 / u.g)
             weighted_coeffs[name] = clean
-        return AttenuationData(weighted_coeffs)
+        return cls(weighted_coeffs)
 
-    def __init__(self, coefficients: dict[str, dict[str, np.ndarray]]):
-        '''Do not call this directly.'''
+    @classmethod
+    def disk_cache_file(cls, formula_key: tuple) -> str:
+        '''
+        File for the merged tables of a normalized formula. It is named after the
+        formula and the element data it is made from (`mman.element_source_digest`),
+        so refreshed NIST data gets a new file instead of the old tables.
+        '''
+        digests = cls.source_digests(formula_key)
+        h = hashlib.sha1(repr((formula_key, cls.DISK_MAGIC, cls.MERGE_RTOL, cls.MAX_MERGE_REFINEMENTS)).encode())
+        for digest in digests:
+            h.update(digest.encode())
+        return os.path.join(cls.DISK_CACHE_PATH, f'{key_digest(formula_key)[:16]}_{h.hexdigest()}.atten')
+
+    @classmethod
+    def _store(cls, data: 'AttenuationData', path: str):
+        '''
+        save into the disk cache, then remove the tables of the same formula made from
+        older element data and trim the folder down to DISK_CACHE_MAX_BYTES
+        '''
+        data.save(path)
+        folder, file_name = os.path.split(path)
+        formula_tag = file_name.split('_')[0]
+        files = []
+        for other in os.listdir(folder):
+            if not other.endswith('.atten') or other == file_name:
+                continue
+            other = os.path.join(folder, other)
+            with contextlib.suppress(FileNotFoundError):
+                if os.path.basename(other).startswith(f'{formula_tag}_'):
+                    os.remove(other)
+                else:
+                    st = os.stat(other)
+                    files.append((st.st_mtime, st.st_size, other))
+
+        total = os.path.getsize(path) + sum(size for (_, size, _) in files)
+        for (_, size, other) in sorted(files):
+            if total <= cls.DISK_CACHE_MAX_BYTES:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(other)
+            total -= size
+
+    def save(self, path: str):
+        '''
+        Write the element and merged tables to one memory-mappable file (little endian):
+            8 bytes        DISK_MAGIC
+            int64          header length
+            header         JSON list of [name, length] of the blocks, padded to 8 bytes
+            float64[...]   the blocks, one after the other
+        '''
+        names = AttenuationType.named()
+        blocks = []
+        for (elt, energies) in self.energies.items():
+            blocks.append((f'{elt}/energy', energies))
+            blocks += [(f'{elt}/{names[t]}', self.attenuations[elt][t]) for t in AttenuationType.ALL]
+        for (t, table) in self.tables.items():
+            blocks += [(f'table/{t}/log_x', table.log_x), (f'table/{t}/log_y', table.log_y)]
+        header = json.dumps([[name, int(arr.size)] for (name, arr) in blocks]).encode()
+        header += b' ' * (-len(header) % 8)
+
+        with atomic_write(path) as tmp, open(tmp, 'wb') as f:
+            f.write(self.DISK_MAGIC)
+            f.write(np.array([len(header)], dtype='<i8').tobytes())
+            f.write(header)
+            for (_, arr) in blocks:
+                f.write(np.ascontiguousarray(arr, dtype='<f8').tobytes())
+
+    @classmethod
+    def load(cls, path: str):
+        ''' data written by `save`; the arrays are read-only views of a memory map '''
+        raw = np.asarray(np.memmap(path, dtype=np.uint8, mode='r'))
+        start = len(cls.DISK_MAGIC)
+        if raw.size < start + 8 or raw[:start].tobytes() != cls.DISK_MAGIC:
+            raise ValueError('not a compound table file')
+        header_size = int(raw[start:start + 8].view('<i8')[0])
+        start += 8
+        layout = json.loads(raw[start:start + header_size].tobytes())
+        values = raw[start + header_size:].view('<f8')
+        if values.size != sum(size for (_, size) in layout):
+            raise ValueError('file is truncated')
+
+        coefficients, tables = dict(), dict()
+        pos = 0
+        for (name, size) in layout:
+            block = values[pos:pos + size]
+            pos += size
+            first, rest = name.split('/', 1)
+            if first == 'table':
+                t, which = rest.split('/')
+                tables.setdefault(int(t), dict())[which] = block
+            else:
+                coefficients.setdefault(first, dict())[rest] = block
+        tables = {t: (v['log_x'], v['log_y']) for (t, v) in tables.items()}
+        return cls(coefficients, tables)
+
+    def __init__(self, coefficients: dict[str, dict[str, np.ndarray]], tables: dict=None):
+        '''
+        Do not call this directly.
+        tables: merged (log energy, log attenuation) by attenuation type, if they are known already.
+        '''
+        # normalized formula and digests of the element data it came from, when we know them
+        self.formula_key = None
+        self.source_key = None
+        self._instance_number = next(AttenuationData._instance_numbers)
         self.energies = dict()
         self.attenuations = dict()
+        self.absorption_edges = dict()
         for (k, data) in coefficients.items():
             self.energies[k] = data['energy']
+            self.absorption_edges[k] = mman.find_absorption_edges(
+                data['energy'] << u.keV).to_value(u.keV)
             if k not in self.attenuations:
                 self.attenuations[k] = dict()
 
@@ -52,34 +236,88 @@ class AttenuationData:
             self.attenuations[k][
                 AttenuationType.COMPTON] = data['compton']
         
-        self.setup_interpolators()
+        # every edge of every element in the compound (keV)
+        self.compound_edges = np.unique(np.concatenate(
+            [np.empty(0)] + list(self.absorption_edges.values())))
+
+        if tables is None:
+            self.setup_interpolators()
+        else:
+            self.tables = {k: _LogLogTable(*v) for (k, v) in tables.items()}
 
     def setup_interpolators(self):
-        ''' returns a function that interpolates log of attenuation
-            data (to be integrated or evaluated),
-            one per element
         '''
-        interp_log_att_funcs = {k: [] for k in AttenuationType.ALL}
+        Merge the element data into one log-log table per attenuation type,
+        sampled on the union of the element energy grids.
+        Straight lines between table points (on the log plot) are power laws,
+        but a sum of power laws with different slopes is not one, so segments
+        get split until their midpoint matches the element sum to MERGE_RTOL
+        (see `transmission.refine_power_law_table`).
+        The 1e-10 MeV steps at absorption edges are an artifact of the data,
+        so their shape is left alone.
+        '''
+        element_tables = {k: [] for k in AttenuationType.ALL}
         for (name, data) in self.attenuations.items():
-            energies = self.energies[name]
+            loge = np.log(self.energies[name])
             for key, att in data.items():
-                # interpolate between NIST energies
-                # we want straight-line interpolation on the log plot,
-                # so take the log before doing any fitting
-                loge, logat = np.log(energies), np.log(att)
-                interp_func = interpolate.interp1d(
-                    x=loge, y=logat,
-                    fill_value="extrapolate"
-                )
-                interp_log_att_funcs[key].append(interp_func)
-        
-        self.log_interpolators = interp_log_att_funcs
+                element_tables[key].append(_LogLogTable(loge, np.log(att)))
+
+        union_loge = np.log(np.unique(np.concatenate(list(self.energies.values()))))
+        edge_step = 2 * mman.EDGE_NUDGE.to_value(u.keV)
+        self.tables = dict()
+        for (key, tables) in element_tables.items():
+            element_sum = lambda loge: np.log(sum(np.exp(t(loge)) for t in tables))
+            self.tables[key] = _LogLogTable(*transmission.refine_power_law_table(
+                element_sum, union_loge, self.MERGE_RTOL, self.MAX_MERGE_REFINEMENTS,
+                splittable=lambda loge, _: np.diff(np.exp(loge)) > edge_step))
+
+    @property
+    def cache_key(self):
+        ''' identifies this data in response caches '''
+        if self.formula_key is None:
+            return ('instance', self._instance_number)
+        return (self.formula_key, self.source_key)
+
+    def freeze(self):
+        ''' make the data read-only so that it can be shared safely '''
+        arrays = list(self.energies.values()) + list(self.absorption_edges.values())
+        arrays += [self.compound_edges]
+        arrays += [a for d in self.attenuations.values() for a in d.values()]
+        arrays += [a for t in self.tables.values() for a in (t.log_x, t.log_y, t.slopes)]
+        for a in arrays:
+            a.flags.writeable = False
 
     def log_interpolate(self, att_type, log_energies) -> np.ndarray:
         '''
         Log-interpolate a given attenuation type to a set of log energies.
         '''
-        ret = np.zeros_like(log_energies)
-        for f in self.log_interpolators[att_type]:
-            ret += np.exp(f(log_energies))
-        return np.log(ret)
+        return self.tables[att_type](log_energies)
+
+    def interpolate(self, att_type, energies) -> np.ndarray:
+        '''
+        Mass attenuation coefficients (cm2/g) of a given type at some energies (keV).
+        '''
+        return np.exp(self.tables[att_type](np.log(energies)))
+
+    def log_log_table(self, att_type) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        (log energy, log attenuation) of the whole compound.
+        Straight lines between the points make the attenuation a power law
+        a * E**b on every segment.
+        '''
+        table = self.tables[att_type]
+        return table.log_x, table.log_y
+
+
+class _LogLogTable:
+    '''
+    Piecewise-linear function of log x, with the segment slopes cached.
+    Extrapolates past either end along the end segments.
+    '''
+    def __init__(self, log_x: np.ndarray, log_y: np.ndarray):
+        self.log_x, self.log_y = log_x, log_y
+        self.slopes = np.diff(log_y) / np.diff(log_x)
+
+    def __call__(self, log_x) -> np.ndarray:
+        idx = np.clip(np.searchsorted(self.log_x, log_x) - 1, 0, self.slopes.size - 1)
+        return self.log_y[idx] + self.slopes[idx] * (log_x - self.log_x[idx])
@@ -2,6 +2,9 @@ import numpy as np
 from .AttenuationData import AttenuationType
 from .FlareSpectrum import FlareSpectrum
 from .PhotonDetector import PhotonDetector
+from .ResponseOperator import ResponseOperator, DiagonalResponse
+from . import folding
+from . import transmission
 
 class DetectorStack:
     '''
@@ -10,33 +13,104 @@ class DetectorStack:
     # XXX: we are dragging around a FlareSpectrum object because eventually Compton scattering may need
     # access to the energy vector (because it is energy nonconserving) and detector energy dispersion
     # also needs the energy vector.
-    def __init__(self, materials: list, photon_detector: PhotonDetector):
-        '''position zero in the materials array corresponds to the outermost one'''
+    def __init__(self, materials: list, photon_detector: PhotonDetector, fuse_optical_depth: bool=True):
+        '''
+        position zero in the materials array corresponds to the outermost one.
+        fuse_optical_depth: sum the optical depths of every material and integrate the
+            combined transmission once, using the outermost material's integration settings.
+            otherwise, multiply together the bin-averaged transmission of each material.
+        '''
         self.materials = materials
         self.photon_detector = photon_detector
+        self.fuse_optical_depth = fuse_optical_depth
 
     def generate_detector_response_to(
             self, incident_spectrum: FlareSpectrum, disperse_energy: bool, chosen_attenuations: list=AttenuationType.ALL) -> np.ndarray:
-        response = self._generate_material_response_due_to(incident_spectrum, chosen_attenuations)
+        ''' dense response matrix. see `generate_response_operator` to avoid writing it out. '''
+        return self.generate_response_operator(incident_spectrum, disperse_energy, chosen_attenuations).toarray()
+
+    def generate_response_operator(
+            self, incident_spectrum: FlareSpectrum, disperse_energy: bool, chosen_attenuations: list=AttenuationType.ALL) -> ResponseOperator:
+        ''' subclasses with a detector volume override this one '''
+        response = DiagonalResponse(self._generate_material_transmission(incident_spectrum, chosen_attenuations))
         return self._dispatch_dispersion(incident_spectrum, response, disperse_energy)
 
-    def apply_detector_dispersion_for(self, incident_spectrum: FlareSpectrum, resp_matrix: np.ndarray) -> np.ndarray:
-        pd_spread = self.photon_detector.generate_energy_resolution_given(incident_spectrum)
-        if resp_matrix.ndim == 2: return pd_spread @ resp_matrix
-        return pd_spread @ np.diag(resp_matrix)
+    def fold_spectra(
+            self, incident_spectrum: FlareSpectrum, spectra: np.ndarray, disperse_energy: bool=True,
+            bands=(), chosen_attenuations: list=AttenuationType.ALL, **kwargs) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Fold a (T, N) block of spectra on the energy edges of incident_spectrum
+        through this stack's response. See `folding.fold_spectra` for the rest.
+        '''
+        response = self.generate_response_operator(incident_spectrum, disperse_energy, chosen_attenuations)
+        return folding.fold_spectra(response, spectra, incident_spectrum.energy_edges, bands, **kwargs)
+
+    def apply_detector_dispersion_for(self, incident_spectrum: FlareSpectrum, resp_matrix):
+        '''
+        apply the photon detector energy resolution to a response.
+        ResponseOperators stay operators; arrays (diagonal vector or matrix) give back arrays.
+        The spread is whatever `PhotonDetector.energy_resolution_operator` gives, usually banded.
+        '''
+        spread = self.photon_detector.energy_resolution_operator(incident_spectrum)
+        if isinstance(resp_matrix, ResponseOperator): return spread @ resp_matrix
+        if resp_matrix.ndim == 2: return spread.apply(resp_matrix)
+        # same as spread @ np.diag(resp_matrix)
+        return (spread @ DiagonalResponse(resp_matrix)).toarray()
 
     def _generate_material_response_due_to(self, incident_spectrum: FlareSpectrum, attenuations: list) -> np.ndarray:
         ''' don't call this directly. doesn't include scintillator effects. '''
+        return np.diag(self._generate_material_transmission(incident_spectrum, attenuations))
+
+    def _generate_material_transmission(self, incident_spectrum: FlareSpectrum, attenuations: list) -> np.ndarray:
+        ''' diagonal of `_generate_material_response_due_to` '''
+        if self.fuse_optical_depth and self.materials:
+            optical_depth = sum(
+                (m.optical_depth(attenuations) for m in self.materials),
+                transmission.OpticalDepth())
+            return self.materials[0].bin_averaged_transmission(optical_depth, incident_spectrum)
+
         response = np.ones(incident_spectrum.energy_edges.size - 1)
         for material in self.materials:
             response *= material.generate_overall_response_matrix_given(incident_spectrum, attenuations)
-        return np.diag(response)
+        return response
 
-    def _dispatch_dispersion(self, incident_spectrum: FlareSpectrum, response: np.ndarray, do_it: bool):
+    def material_response_for_thicknesses(
+            self, incident_spectrum: FlareSpectrum, layer: int, thicknesses: np.ndarray,
+            attenuations: list=AttenuationType.ALL, order: int=16) -> np.ndarray:
+        '''
+        Transmission through the stack materials (not the detector) for several
+        thicknesses of one layer, e.g. an attenuator scan, in one vectorized call.
+        layer: index into self.materials of the layer to vary.
+        order: Gauss-Legendre points per bin piece when the optical depths are fused.
+        returns: (thicknesses.size, number of bins) block; row i is the diagonal of the
+            material response with materials[layer] set to thicknesses[i].
+        Fused stacks average exp(-tau_others - t * tau_layer) across each bin for every
+        thickness t, on fixed quadrature nodes (see `transmission.bin_quadrature`).
+        Otherwise the varied layer is bin-averaged on its own and multiplied onto
+        the other layers, same as the stack does.
+        '''
+        varied = self.materials[layer]
+        others = self.materials[:layer] + self.materials[layer+1:]
+        if not self.fuse_optical_depth:
+            fixed = DetectorStack(others, self.photon_detector, False)._generate_material_transmission(
+                incident_spectrum, attenuations)
+            return fixed * varied.transmission_for_thicknesses(thicknesses, incident_spectrum, attenuations)
+
+        edges = np.asarray(incident_spectrum.energy_edges, dtype=np.float64)
+        thicknesses = np.atleast_1d(np.asarray(thicknesses, dtype=np.float64))
+        unit_depth = varied.optical_depth(attenuations, thickness=1.0)
+        other_depth = sum((m.optical_depth(attenuations) for m in others), transmission.OpticalDepth())
+        nodes, weights, owner = transmission.bin_quadrature(
+            edges, (unit_depth + other_depth).breakpoints, order)
+        unit_tau = unit_depth(nodes.ravel()).reshape(nodes.shape)
+        weights = weights * np.exp(-other_depth(nodes.ravel())).reshape(nodes.shape)
+        pieces = np.einsum('tpo,po->tp', np.exp(-thicknesses[:, None, None] * unit_tau), weights)
+        return np.array([np.bincount(owner, weights=p, minlength=edges.size - 1) for p in pieces])
+
+    def _dispatch_dispersion(self, incident_spectrum: FlareSpectrum, response, do_it: bool):
         if do_it: return self.apply_detector_dispersion_for(incident_spectrum, response)
         else: return response
 
     @property
     def area(self):
         return self.materials[0].area
-
@@ -2,10 +2,12 @@ from typing import Tuple
 import astropy.units as u
 import functools
 import numpy as np
-try:
-    import sunkit_spex.thermal as thermal
-except ModuleNotFoundError:
-    import sunkit_spex.legacy.thermal as thermal
+
+from .LazyModule import LazyModule
+from .ThermalTable import ThermalTable
+
+# sunkit-spex is slow to import, so wait until a thermal spectrum is needed
+thermal = LazyModule('sunkit_spex.thermal', 'sunkit_spex.legacy.thermal')
 
 GOES_PREFIX = {
     'A': 1e-8,
@@ -30,6 +32,10 @@ def power_law_integral(energy=0, norm_energy=1, norm=1, index=1):
     '''
     prefactor = norm * norm_energy
     arg = energy / norm_energy
+    if np.ndim(index) > 0:
+        # arrays of indices (broadcast against energy) may mix in index == 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return prefactor * np.where(index == 1, np.log(arg), arg**(1 - index) / (1 - index))
     if index == 1:
         return prefactor * np.log(arg)
     return prefactor * arg**(1 - index) / (1 - index)
@@ -40,47 +46,34 @@ def broken_power_law_binned_flux(
         reference_energy, reference_flux,
         break_energy, lower_index, upper_index):
     ''' use analytically integrated broken power law to get flux in given energy bins '''
-    norm_idx = lower_index if reference_energy <= break_energy else upper_index
-    # norm is from continuity at break energy and solving.
-    norm = reference_flux * (reference_energy / break_energy)**(norm_idx)
-
-    cnd = energy_edges <= break_energy
-    lower = energy_edges[cnd]
-    upper = energy_edges[~cnd]
-
-    up_integ = functools.partial(
-        power_law_integral,
-        norm_energy=break_energy,
-        norm=norm,
-        index=upper_index
-    )
-    low_integ = functools.partial(
-        power_law_integral,
-        norm_energy=break_energy,
-        norm=norm,
-        index=lower_index
-    )
-
-    lower_portion = low_integ(energy=lower[1:])
-    lower_portion -= low_integ(energy=lower[:-1])
-
-    upper_portion = up_integ(energy=upper[1:])
-    upper_portion -= up_integ(energy=upper[:-1])
-
-    twixt_portion = []
-    # bin between the portions is comprised of both power laws
-    if lower.size > 0 and upper.size > 0:
-        twixt_portion = np.diff(
-            low_integ(energy=np.array([break_energy, upper[0]]))
-        )
-        twixt_portion += np.diff(
-            up_integ(energy=np.array([lower[-1], break_energy]))
-        )
+    return broken_power_law_binned_fluxes(
+        energy_edges, reference_energy, reference_flux,
+        break_energy, lower_index, upper_index)[0]
 
-    ret = np.concatenate((lower_portion, twixt_portion, upper_portion))
-    assert ret.size == (energy_edges.size - 1)
+
+def broken_power_law_binned_fluxes(
+        energy_edges,
+        reference_energy, reference_flux,
+        break_energy, lower_index, upper_index):
+    '''
+    broken_power_law_binned_flux for many spectra at once: the parameters can be
+    arrays of K values (or scalars shared by all). returns a (K, number of bins) block.
+    '''
+    edges = np.asarray(energy_edges, dtype=np.float64)
+    (reference_energy, reference_flux, lower_index, upper_index) = (
+        np.asarray(p, dtype=np.float64).reshape(-1, 1)
+        for p in (reference_energy, reference_flux, lower_index, upper_index))
+    norm_idx = np.where(reference_energy <= break_energy, lower_index, upper_index)
+    norm = reference_flux * (reference_energy / break_energy)**norm_idx
+
+    low_integ = functools.partial(power_law_integral, norm_energy=break_energy, norm=norm, index=lower_index)
+    up_integ = functools.partial(power_law_integral, norm_energy=break_energy, norm=norm, index=upper_index)
+    # the part of each bin below the break follows the lower power law, the part above the upper one.
+    # bins entirely on one side get a zero-width piece on the other.
+    below, above = np.minimum(edges, break_energy), np.maximum(edges, break_energy)
+    ret = np.diff(low_integ(energy=below), axis=-1) + np.diff(up_integ(energy=above), axis=-1)
     # go back to units of cm2/sec/keV
-    return ret / np.diff(energy_edges)
+    return ret / np.diff(edges)
 
 
 class BattagliaParameters:
@@ -96,10 +89,11 @@ class BattagliaParameters:
         self.reference_energy = 35.0                                            # keV
         self.reference_flux = (goes_flux / (1.8e-5)) ** (1/0.83)                # photon / (s cm2 keV)
 
-        if goes_flux < goes_class_lookup('C2'):
-            self.spectral_index = 2.04 * self.reference_flux**(-0.16)           # unitless
-        else:
-            self.spectral_index = 3.60 * self.reference_flux**(-0.16)           # unitless
+        # works for a single flux or an array of them
+        below_c2 = np.asarray(goes_flux) < goes_class_lookup('C2')
+        self.spectral_index = np.where(below_c2, 2.04, 3.60) * self.reference_flux**(-0.16)  # unitless
+        if np.ndim(goes_flux) == 0:
+            self.spectral_index = self.spectral_index.item()
 
     def gen_vth_params(self) -> Tuple[float, float]:
         K_B = 8.627e-8  # keV/K
@@ -112,15 +106,21 @@ class BattagliaParameters:
         return {'pt': pt, 'em': em}
 
     def __repr__(self):
+        # batches hold arrays; long ones get summarized
+        fmt = lambda v: np.array2string(
+            np.asarray(v), threshold=6, edgeitems=2, formatter={'float_kind': lambda x: f'{x:.3f}'})
         return '<' + ', '.join([
-            f'Emission measure {self.emission_measure/1e49:.3f}e49 particle2 / cm3',
-            f'Plasma temp {self.plasma_temp:.3f} MK',
-            f'Spectral index {self.spectral_index:.3f}'
+            f'Emission measure {fmt(self.emission_measure/1e49)}e49 particle2 / cm3',
+            f'Plasma temp {fmt(self.plasma_temp)} MK',
+            f'Spectral index {fmt(self.spectral_index)}'
         ]) + '>'
 
 
 class FlareSpectrum:
     _ENERGY_LIMITS = (1.001, 200.15)
+    # names the thermal model in thermal table keys, so finding a
+    # table doesn't have to import sunkit_spex
+    _THERMAL_MODEL = 'sunkit_spex.thermal.thermal_emission'
     @classmethod
     def make_with_battaglia_scaling(
             cls, goes_class: str, energy_edges: np.ndarray,
@@ -129,21 +129,103 @@ class FlareSpectrum:
         bp = BattagliaParameters(goes_class_lookup(goes_class))
 
         edges = energy_edges
+        thermal_spec = cls.thermal_for(bp.plasma_temp, bp.emission_measure, edges)
 
+        # change to binned version
+        nonthermal_spec = broken_power_law_binned_flux(
+            energy_edges=edges,
+            reference_energy=bp.reference_energy,
+            reference_flux=bp.reference_flux,
+            break_energy=break_energy,
+            lower_index=bp.BELOW_INDEX,
+            upper_index=bp.spectral_index
+        )
+
+        return cls(
+            goes_class=goes_class,
+            energy_edges=energy_edges,
+            thermal=thermal_spec,
+            nonthermal=nonthermal_spec)
+
+    @classmethod
+    def make_batch_with_battaglia_scaling(
+            cls, goes_fluxes: np.ndarray, energy_edges: np.ndarray,
+            rel_abun=1.0, break_energy=BATTAGLIA_BREAK_ENERGY, use_thermal_table: bool=True):
+        '''
+        make_with_battaglia_scaling for an array of K GOES fluxes (W/m2, numbers rather
+        than class strings). thermal, nonthermal and flare are (K, number of bins) blocks
+        on the shared energy edges, and goes_flux is the array of fluxes.
+        The Battaglia scalings and power laws are vectorized across K.
+        use_thermal_table: interpolate the thermal emission in `thermal_table` (built the
+            first time a grid is used, then kept on disk). Temperatures outside of the table,
+            or all of them if this is False, get thermal_emission once per distinct
+            (temperature, emission measure).
+        '''
+        goes_fluxes = np.asarray(goes_fluxes, dtype=np.float64).reshape(-1)
+        bp = BattagliaParameters(goes_fluxes)
+
+        thermal_spec = np.empty((goes_fluxes.size, energy_edges.size - 1))
+        direct = np.ones(goes_fluxes.size, dtype=bool)
+        if use_thermal_table:
+            table = cls.thermal_table(energy_edges)
+            direct = ~table.covers(bp.plasma_temp)
+            thermal_spec[~direct] = table(bp.plasma_temp[~direct], bp.emission_measure[~direct])
+        if np.any(direct):
+            params = np.column_stack((bp.plasma_temp[direct], bp.emission_measure[direct]))
+            (distinct, which) = np.unique(params, axis=0, return_inverse=True)
+            distinct_thermal = np.array(
+                [cls.thermal_for(pt, em, energy_edges) for (pt, em) in distinct]
+            ).reshape(distinct.shape[0], energy_edges.size - 1)
+            thermal_spec[direct] = distinct_thermal[which.reshape(-1)]
+
+        nonthermal_spec = broken_power_law_binned_fluxes(
+            energy_edges=energy_edges,
+            reference_energy=bp.reference_energy,
+            reference_flux=bp.reference_flux,
+            break_energy=break_energy,
+            lower_index=bp.BELOW_INDEX,
+            upper_index=bp.spectral_index
+        )
+
+        ret = cls(
+            goes_class=None,
+            energy_edges=energy_edges,
+            thermal=thermal_spec,
+            nonthermal=nonthermal_spec)
+        ret._goes_flux = goes_fluxes
+        return ret
+
+    @classmethod
+    def thermal_table(cls, energy_edges: np.ndarray, temperatures: np.ndarray=None) -> ThermalTable:
+        ''' tabulated `thermal_for` on these energy edges; see ThermalTable '''
+        reference_em = 1e49
+        return ThermalTable.for_grid(
+            np.asarray(energy_edges, dtype=np.float64),
+            lambda pt, edges: cls.thermal_for(pt, reference_em, edges) / reference_em,
+            temperatures,
+            key_extra=(cls._THERMAL_MODEL, cls._ENERGY_LIMITS))
+
+    @staticmethod
+    def thermal_for(plasma_temp, emission_measure, energy_edges: np.ndarray) -> np.ndarray:
+        '''
+        thermal spectrum for a plasma temperature (MK) and emission measure (cm-3),
+        zero outside of _ENERGY_LIMITS
+        '''
+        edges = energy_edges
         over_cnd = edges > FlareSpectrum._ENERGY_LIMITS[0]
         under_cnd = edges < FlareSpectrum._ENERGY_LIMITS[1]
         thermal_edges = edges[over_cnd & under_cnd]
 
         thermal_spec = thermal.thermal_emission(
-            thermal_edges * u.keV, bp.plasma_temp * u.MK,
-            bp.emission_measure * (u.cm**(-3)),
+            thermal_edges * u.keV, plasma_temp * u.MK,
+            emission_measure * (u.cm**(-3)),
         ).value
 
         # make thermal/nonthermal spectra the same size
         verify = lambda n: n if n > 0 else 0
         under_elts, over_elts = np.sum(~over_cnd), np.sum(~under_cnd)
         under_pad, over_pad = np.zeros(verify(under_elts)), np.zeros(verify(over_elts))
-        thermal_spec = np.concatenate(
+        return np.concatenate(
             (
                 under_pad,
                 thermal_spec,
@@ -151,22 +233,6 @@ class FlareSpectrum:
             )
         )
 
-        # change to binned version
-        nonthermal_spec = broken_power_law_binned_flux(
-            energy_edges=edges,
-            reference_energy=bp.reference_energy,
-            reference_flux=bp.reference_flux,
-            break_energy=break_energy,
-            lower_index=bp.BELOW_INDEX,
-            upper_index=bp.spectral_index
-        )
-
-        return cls(
-            goes_class=goes_class,
-            energy_edges=energy_edges,
-            thermal=thermal_spec,
-            nonthermal=nonthermal_spec)
-
     def __init__(self,
                  goes_class: str,
                  thermal: np.ndarray, nonthermal: np.ndarray,
@@ -174,9 +240,13 @@ class FlareSpectrum:
         self.goes_class = goes_class
         self.energy_edges = energy_edges
         self.thermal, self.nonthermal = thermal, nonthermal
+        # batches know their fluxes directly
+        self._goes_flux = None
 
     @property
     def goes_flux(self) -> np.float64:
+        if self._goes_flux is not None:
+            return self._goes_flux
         return goes_class_lookup(self.goes_class)
 
     @property
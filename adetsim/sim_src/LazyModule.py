@@ -0,0 +1,56 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    '''
+    Stands in for a module which is slow to import (or not always installed)
+    and imports it the first time one of its attributes is used:
+
+        plt = LazyModule('matplotlib.pyplot')
+        ...
+        fig, ax = plt.subplots()    # matplotlib gets imported here
+
+    names: module names to try in order, e.g. a new location then an old one.
+    on_load: called with the module right after it is imported (e.g. to set a plot style).
+    '''
+    _PASSED_THROUGH = ('__name__', '__file__', '__version__')
+
+    def __init__(self, *names: str, on_load=None):
+        self._names = names
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is not None:
+                return self._module
+            for name in self._names[:-1]:
+                try:
+                    module = importlib.import_module(name)
+                    break
+                except ModuleNotFoundError:
+                    continue
+            else:
+                module = importlib.import_module(self._names[-1])
+            if self._on_load is not None:
+                self._on_load(module)
+            self._module = module
+            return module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr: str):
+        # only called for attributes this object doesn't have itself.
+        # other private and special names don't import anything, so copying,
+        # pickling and introspection leave the module alone
+        if attr.startswith('_') and attr not in self._PASSED_THROUGH:
+            raise AttributeError(attr)
+        return getattr(self._module or self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded yet'
+        return f'<LazyModule {" or ".join(self._names)}, {state}>'
@@ -1,23 +1,40 @@
 import numpy as np
-from scipy import integrate
 from .AttenuationData import AttenuationData, AttenuationType
 from .FlareSpectrum import FlareSpectrum
+from . import transmission
+from .caching import LruCache, array_digest
 
 class Material:
+    # bin-averaged transmissions shared by all materials (and fused stacks), keyed on
+    # formula, mechanism, areal density (rho * t), energy edges, and integration settings.
+    # set max_entries to 0 to turn it off.
+    response_cache = LruCache(max_entries=4096, max_bytes=256 * 2**20)
+
     def __init__(self, diameter: np.float64, attenuation_thickness: np.float64,
                  mass_density: np.float64, attenuation_data: AttenuationData,
-                 name: str=None):
+                 name: str=None, integration_mode: str=None, integration_options: dict=None,
+                 fuse_optical_depth: bool=True):
         self.name = name or "(no name given)"
         self.diameter = diameter
         self.mass_density = mass_density
         self.attenuation_data = attenuation_data
         self.thickness = attenuation_thickness
+        # see `transmission.IntegrationMode`; None picks the default engine.
+        # options (e.g. rtol) get passed along to the engine
+        self.integration_mode = integration_mode
+        self.integration_options = integration_options or dict()
+        # integrate exp(-sum of optical depths) once rather than
+        # multiplying the per-mechanism bin averages
+        self.fuse_optical_depth = fuse_optical_depth
 
     @property
     def area(self):
         return (self.diameter / 2)**2 * np.pi
 
     def generate_overall_response_matrix_given(self, incident_spectrum: FlareSpectrum, attenuations: list) -> np.ndarray:
+        if self.fuse_optical_depth:
+            return self.bin_averaged_transmission(self.optical_depth(attenuations), incident_spectrum)
+
         dim = incident_spectrum.energy_edges.size - 1
         vec = np.ones(dim, dtype=np.float64)
         # everything is diagonal except Compton scattering, so the matrices commute
@@ -34,28 +51,50 @@ class Material:
         }
         return modify_gen_lookup[mechanism_type](incident_spectrum)
 
-    def _gen_phot_ray(self, which, incident_spectrum: FlareSpectrum) -> np.ndarray:
-        # Log attenuation function (to interpolaetaeaeae)
-        log_att = lambda e: self.attenuation_data.log_interpolate(which, e)
-
-        def mass_att_exponent(log_energy):
-            return -1 * np.exp(log_att(log_energy)) * self.mass_density * self.thickness
-        def transm_prob(energy):
-            return np.exp(mass_att_exponent(np.log(energy)))
+    def optical_depth(self, attenuations: list, thickness: np.float64=None) -> transmission.OpticalDepth:
+        '''
+        optical depth due to the given mechanisms. Compton is not implemented so it is left out.
+        thickness defaults to the material's own.
+        '''
+        areal_density = self.mass_density * (self.thickness if thickness is None else thickness)
+        return transmission.OpticalDepth([
+            (self.attenuation_data, k, areal_density)
+            for k in dict.fromkeys(attenuations) if k != AttenuationType.COMPTON
+        ])
 
-        # average the interaction probabilities across a bin via integration
-        ret = np.zeros(incident_spectrum.flare.size)
+    def bin_averaged_transmission(self, optical_depth: transmission.OpticalDepth, incident_spectrum: FlareSpectrum) -> np.ndarray:
+        ''' average the transmission probabilities across each bin. results are cached and read-only. '''
         edges = incident_spectrum.energy_edges
-        for i in range(edges.size - 1):
-            integrated_transm_prob, _ = integrate.quad(
-                transm_prob,
-                edges[i],
-                edges[i+1]
-            )
-            avg_transm_prob = integrated_transm_prob / (edges[i+1] - edges[i])
-            ret[i] = avg_transm_prob
+        mode = self.integration_mode or transmission.IntegrationMode.DEFAULT
+        key = (
+            optical_depth.cache_key, array_digest(edges),
+            mode, tuple(sorted(self.integration_options.items()))
+        )
+        def compute():
+            ret = transmission.bin_averaged_transmission(
+                optical_depth, edges, mode=mode, **self.integration_options)
+            ret.flags.writeable = False
+            return ret
+        return self.response_cache.get_or_compute(key, compute)
 
-        return ret
+    def transmission_for_thicknesses(
+            self, thicknesses: np.ndarray, incident_spectrum: FlareSpectrum, attenuations: list) -> np.ndarray:
+        '''
+        Bin-averaged transmission through this material for each of the given thicknesses (cm).
+        mu(E) only gets evaluated once, so this is much cheaper than changing the thickness
+        and calling `generate_overall_response_matrix_given` over and over.
+        returns: (thicknesses.size, number of bins) block; the mechanisms are always fused here.
+        '''
+        return transmission.bin_averaged_transmission(
+            self.optical_depth(attenuations, thickness=1.0),
+            incident_spectrum.energy_edges,
+            mode=self.integration_mode,
+            scales=np.asarray(thicknesses, dtype=np.float64),
+            **self.integration_options
+        )
+
+    def _gen_phot_ray(self, which, incident_spectrum: FlareSpectrum) -> np.ndarray:
+        return self.bin_averaged_transmission(self.optical_depth([which]), incident_spectrum)
 
     def _gen_photo(self, incident_spectrum: FlareSpectrum) -> np.ndarray:
         return self._gen_phot_ray(AttenuationType.PHOTOELECTRIC_ABSORPTION, incident_spectrum)
@@ -1,6 +1,71 @@
 import numpy as np
+import os
+from scipy import sparse
 from .FlareSpectrum import FlareSpectrum
+from .ResponseOperator import ResponseOperator, DenseResponse
+from .caching import LruCache, array_digest, atomic_write, key_digest
 
 class PhotonDetector:
+    # energy resolutions only depend on the detector parameters and the energy grid,
+    # so every detector (and every stack/container holding one) shares this cache.
+    resolution_cache = LruCache(max_entries=32, max_bytes=2 * 2**30)
+    # set to a directory to also keep the resolutions on disk between runs
+    resolution_cache_dir = None
+
+    @property
+    def resolution_parameters(self) -> tuple:
+        ''' everything besides the energy grid the energy resolution depends on. None turns off caching. '''
+        return None
+
     def generate_energy_resolution_given(self, incident_spectrum: FlareSpectrum) -> np.ndarray:
+        ''' dense energy resolution matrix, cached; subclasses implement `_build_energy_resolution` '''
+        return self._cached_resolution(
+            'dense', incident_spectrum, lambda: self._build_energy_resolution(incident_spectrum))
+
+    def energy_resolution_operator(self, incident_spectrum: FlareSpectrum) -> ResponseOperator:
+        ''' the energy resolution as a ResponseOperator. override to avoid building the dense matrix. '''
+        return DenseResponse(self.generate_energy_resolution_given(incident_spectrum))
+
+    def _build_energy_resolution(self, incident_spectrum: FlareSpectrum) -> np.ndarray:
         raise NotImplementedError("Subclass PhotonDetector to implement detector-specific behavior.")
+
+    def _cached_resolution(self, kind: str, incident_spectrum: FlareSpectrum, build):
+        '''
+        look up (or build and store) a dense array or sparse matrix describing
+        the energy resolution. kind tells apart different representations.
+        '''
+        params = self.resolution_parameters
+        if params is None:
+            return build()
+        edges = np.asarray(incident_spectrum.energy_edges, dtype=np.float64)
+        key = (type(self).__name__, params, kind, array_digest(edges))
+        return self.resolution_cache.get_or_compute(key, lambda: self._load_or_build(key, build))
+
+    def _load_or_build(self, key: tuple, build):
+        directory = self.resolution_cache_dir
+        path = None if directory is None else os.path.join(directory, f'{key_digest(key)}.npz')
+        if path is not None and os.path.exists(path):
+            ret = _load_matrix(path)
+        else:
+            ret = build()
+            if path is not None:
+                _save_matrix(path, ret)
+        if isinstance(ret, np.ndarray):
+            # shared between callers
+            ret.flags.writeable = False
+        return ret
+
+
+def _save_matrix(path: str, matrix):
+    with atomic_write(path, '.npz') as tmp:
+        if sparse.issparse(matrix):
+            sparse.save_npz(tmp, matrix, compressed=False)
+        else:
+            np.savez(tmp, dense=matrix)
+
+
+def _load_matrix(path: str):
+    with np.load(path) as data:
+        if 'dense' in data:
+            return data['dense']
+    return sparse.load_npz(path)
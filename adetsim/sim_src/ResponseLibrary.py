@@ -0,0 +1,149 @@
+import json
+import os
+
+import numpy as np
+
+from .caching import atomic_write
+
+
+class ResponseLibrary:
+    '''
+    A directory of uncompressed .npy blocks (response matrices, energy edges, spectra, ...)
+    with a JSON index keyed by (GOES class, attenuator thickness, detector):
+
+        library/
+            index.json
+            hafx_M1_1.000e-02cm_0_dispersed_response_matrix.npy
+            ...
+
+    Blocks are memory mapped when they are read, so opening a library or an entry
+    costs nothing and only the parts of the matrices that get used are paged in.
+    '''
+    INDEX_NAME = 'index.json'
+    VERSION = 1
+    # thicknesses (cm) closer than this are the same key
+    THICKNESS_ATOL = 1e-12
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = []
+        index = os.path.join(path, self.INDEX_NAME)
+        if os.path.exists(index):
+            with open(index, 'r') as f:
+                self._entries = json.load(f)['entries']
+
+    def keys(self) -> list:
+        ''' (goes class, thickness in cm, detector) of every entry '''
+        return [self._key_of(e) for e in self._entries]
+
+    def find(self, goes_class: str=None, thickness: float=None, detector: str=None) -> list:
+        ''' keys matching whatever is given '''
+        return [
+            k for k in self.keys()
+            if (goes_class is None or k[0] == goes_class)
+            and (thickness is None or np.isclose(k[1], thickness, rtol=0, atol=self.THICKNESS_ATOL))
+            and (detector is None or k[2] == detector)
+        ]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key: tuple):
+        return self._find_entry(*key) is not None
+
+    def __getitem__(self, key: tuple) -> 'LibraryEntry':
+        entry = self._find_entry(*key)
+        if entry is None:
+            raise KeyError(f'no {key} in response library {self.path}')
+        return LibraryEntry(self.path, entry)
+
+    def add(
+            self, goes_class: str, thickness: float, detector: str,
+            arrays: dict, attrs: dict=None, overwrite: bool=False) -> 'LibraryEntry':
+        '''
+        write named arrays (each to its own .npy) and index them under the key.
+        attrs: small JSON-able extras to keep in the index.
+        '''
+        thickness = float(thickness)
+        existing = self._find_entry(goes_class, thickness, detector)
+        if existing is not None and not overwrite:
+            raise ValueError(f'{(goes_class, thickness, detector)} is already in {self.path}')
+
+        # an overwritten entry keeps its id; the id makes the file names unique
+        # (the rounded thickness in them is only there to make them readable)
+        entry_id = existing['id'] if existing is not None and 'id' in existing else self._next_id()
+        prefix = f'{detector}_{goes_class or "no_goes"}_{thickness:.3e}cm_{entry_id}'
+        files = {name: f'{prefix}_{name}.npy' for name in arrays}
+        taken = {f for e in self._entries if e is not existing for f in e['arrays'].values()}
+        clash = sorted(taken.intersection(files.values()))
+        if clash:
+            raise ValueError(f'{clash} already belong to other entries of {self.path}')
+
+        for (name, arr) in arrays.items():
+            with atomic_write(os.path.join(self.path, files[name]), '.npy') as tmp:
+                np.save(tmp, np.asarray(arr))
+
+        entry = {
+            'id': entry_id, 'goes_class': goes_class, 'thickness': thickness, 'detector': detector,
+            'arrays': files, 'attrs': attrs or dict()
+        }
+        if existing is not None:
+            self._entries.remove(existing)
+        self._entries.append(entry)
+        self._write_index()
+        if existing is not None:
+            # blocks the new version of the entry doesn't have any more
+            for f in set(existing['arrays'].values()) - set(files.values()):
+                if os.path.exists(os.path.join(self.path, f)):
+                    os.remove(os.path.join(self.path, f))
+        return LibraryEntry(self.path, entry)
+
+    def _find_entry(self, goes_class: str, thickness: float, detector: str):
+        for e in self._entries:
+            k = self._key_of(e)
+            if k[0] == goes_class and k[2] == detector and \
+                    np.isclose(k[1], thickness, rtol=0, atol=self.THICKNESS_ATOL):
+                return e
+        return None
+
+    def _next_id(self) -> int:
+        return 1 + max((e.get('id', -1) for e in self._entries), default=-1)
+
+    @staticmethod
+    def _key_of(entry: dict) -> tuple:
+        return entry['goes_class'], entry['thickness'], entry['detector']
+
+    def _write_index(self):
+        index = os.path.join(self.path, self.INDEX_NAME)
+        with atomic_write(index) as tmp, open(tmp, 'w') as f:
+            json.dump({'version': self.VERSION, 'entries': self._entries}, f, indent=1)
+
+    def __repr__(self):
+        return f'<ResponseLibrary {self.path}, {len(self)} entries>'
+
+
+class LibraryEntry:
+    ''' one indexed entry; arrays are memory mapped (read-only) when asked for '''
+    def __init__(self, path: str, entry: dict):
+        self.path = path
+        self.goes_class = entry['goes_class']
+        self.thickness = entry['thickness']
+        self.detector = entry['detector']
+        self.attrs = entry['attrs']
+        self.files = entry['arrays']
+
+    def __contains__(self, name: str):
+        return name in self.files
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, self.files[name]), mmap_mode='r')
+
+    def names(self) -> list:
+        return list(self.files)
+
+    def __repr__(self):
+        return f'<LibraryEntry {self.detector} {self.goes_class} {self.thickness:.3e} cm: {self.names()}>'
+
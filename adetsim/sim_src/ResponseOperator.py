@@ -0,0 +1,143 @@
+import numpy as np
+from scipy import sparse
+
+
+class ResponseOperator:
+    '''
+    A response "matrix" which only gets written out as a dense array when asked for.
+    Apply it to spectra with `@` (from either side), compose operators with `@`,
+    and use `toarray()` (or np.asarray) to materialize it.
+    '''
+    ndim = 2
+    # make numpy defer to __rmatmul__ for `array @ operator` instead of materializing us
+    __array_ufunc__ = None
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        raise NotImplementedError
+
+    @property
+    def T(self) -> 'ResponseOperator':
+        raise NotImplementedError
+
+    def apply(self, x: np.ndarray) -> np.ndarray:
+        ''' self @ x for a vector (N,) or a block of column vectors (N, K) '''
+        raise NotImplementedError
+
+    def toarray(self) -> np.ndarray:
+        return self.apply(np.eye(self.shape[1]))
+
+    def __matmul__(self, other):
+        if isinstance(other, ResponseOperator):
+            return ComposedResponse([self, other])
+        return self.apply(np.asarray(other))
+
+    def __rmatmul__(self, other):
+        # x @ self == (self.T @ x.T).T
+        return self.T.apply(np.asarray(other).T).T
+
+    def __array__(self, dtype=None, copy=None):
+        ret = self.toarray()
+        return ret if dtype is None else ret.astype(dtype)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.shape[0]}x{self.shape[1]}>'
+
+
+class DiagonalResponse(ResponseOperator):
+    ''' no redistribution in energy (e.g. pure attenuation): O(N) storage and application '''
+    def __init__(self, diagonal: np.ndarray):
+        self.diagonal = np.asarray(diagonal)
+
+    @property
+    def shape(self):
+        return (self.diagonal.size, self.diagonal.size)
+
+    @property
+    def T(self):
+        return self
+
+    def apply(self, x):
+        return self.diagonal * x if x.ndim == 1 else self.diagonal[:, None] * x
+
+    def toarray(self):
+        return np.diag(self.diagonal)
+
+    def __matmul__(self, other):
+        if isinstance(other, DiagonalResponse):
+            return DiagonalResponse(self.diagonal * other.diagonal)
+        return super().__matmul__(other)
+
+
+class BandedResponse(ResponseOperator):
+    ''' nonzero only near the diagonal (e.g. truncated energy dispersion); held as a sparse matrix '''
+    def __init__(self, matrix: sparse.spmatrix):
+        self.matrix = sparse.csr_matrix(matrix)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def T(self):
+        return BandedResponse(self.matrix.T)
+
+    def apply(self, x):
+        return self.matrix @ x
+
+    def toarray(self):
+        return self.matrix.toarray()
+
+
+class DenseResponse(ResponseOperator):
+    ''' plain N x N matrix '''
+    def __init__(self, matrix: np.ndarray):
+        self.matrix = np.asarray(matrix)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def T(self):
+        return DenseResponse(self.matrix.T)
+
+    def apply(self, x):
+        return self.matrix @ x
+
+    def toarray(self):
+        return self.matrix
+
+
+class ComposedResponse(ResponseOperator):
+    ''' product of operators, applied right to left; nothing gets multiplied out up front '''
+    def __init__(self, factors: list):
+        self.factors = []
+        for f in factors:
+            self.factors += f.factors if isinstance(f, ComposedResponse) else [f]
+
+    @property
+    def shape(self):
+        return (self.factors[0].shape[0], self.factors[-1].shape[1])
+
+    @property
+    def T(self):
+        return ComposedResponse([f.T for f in reversed(self.factors)])
+
+    def apply(self, x):
+        for f in reversed(self.factors):
+            x = f.apply(x)
+        return x
+
+    def toarray(self):
+        # write out one non-diagonal factor and work outwards from it,
+        # so that diagonal factors only ever scale rows or columns
+        k = next(
+            (i for (i, f) in enumerate(self.factors) if not isinstance(f, DiagonalResponse)),
+            len(self.factors) - 1)
+        ret = np.asarray(self.factors[k].toarray())
+        for f in reversed(self.factors[:k]):
+            ret = f.apply(ret)
+        for f in self.factors[k+1:]:
+            ret = ret @ f
+        return ret
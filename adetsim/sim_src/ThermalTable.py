@@ -0,0 +1,112 @@
+import hashlib
+import os
+import warnings
+
+import numpy as np
+
+from .caching import LruCache, atomic_write, user_cache_dir
+
+
+class ThermalTable:
+    '''
+    Thermal emission per unit emission measure, tabulated on a temperature grid for one
+    energy grid, so that thermal spectra for any number of temperatures are an
+    interpolation instead of a thermal_emission call each.
+    log(emission) is interpolated linearly in log(temperature). The continuum goes like
+    exp(-E / kT), so with grid spacing h in ln T the relative error is about
+    h**2 / 8 * E / kT: ~1e-5 for the default h = 0.002 where E / kT ~ 20.
+    Tables are kept on disk (under CACHE_PATH, in the user's cache directory) and in
+    memory, keyed by a digest of the energy edges, temperatures and whatever else the
+    emission depends on.
+    '''
+    CACHE_PATH = user_cache_dir('thermal')
+    # MK. Battaglia scaling gives ~7 MK for A0.1 up to ~26 MK for X10
+    DEFAULT_TEMPERATURES = np.exp(np.arange(np.log(3), np.log(60), 0.002))
+    cache = LruCache(max_entries=8)
+    # folders we couldn't save to; only warned about once
+    _unwritable_folders = set()
+
+    def __init__(self, energy_edges: np.ndarray, temperatures: np.ndarray, emission: np.ndarray):
+        '''
+        temperatures: increasing grid in MK
+        emission: (temperatures, energy bins) thermal emission for an emission measure of 1 cm-3
+        '''
+        self.energy_edges = np.asarray(energy_edges, dtype=np.float64)
+        self.temperatures = np.asarray(temperatures, dtype=np.float64)
+        self.emission = np.asarray(emission, dtype=np.float64)
+        # bins which are always zero (outside of the thermal model's energy range) stay zero
+        self.zero_bins = np.all(self.emission == 0, axis=0)
+        self._log_t = np.log(self.temperatures)
+        with np.errstate(divide='ignore'):
+            self._log_emission = np.log(np.maximum(self.emission, np.finfo(np.float64).tiny))
+
+    @classmethod
+    def for_grid(
+            cls, energy_edges: np.ndarray, emission_for, temperatures: np.ndarray=None,
+            key_extra: tuple=(), use_disk: bool=True) -> 'ThermalTable':
+        '''
+        Load (from memory or disk) or compute the table for these energy edges.
+        emission_for(temperature in MK, energy_edges): emission for 1 cm-3, only called on a miss.
+        key_extra: anything else the emission depends on (model, abundances, ...).
+        '''
+        temperatures = cls.DEFAULT_TEMPERATURES if temperatures is None else temperatures
+        digest = cls.grid_digest(energy_edges, temperatures, key_extra)
+
+        def load_or_compute():
+            path = os.path.join(cls.CACHE_PATH, f'{digest}.npz')
+            if use_disk and os.path.exists(path):
+                return cls.load(path)
+            ret = cls(energy_edges, temperatures, [emission_for(t, energy_edges) for t in temperatures])
+            if use_disk:
+                try:
+                    ret.save(path)
+                except OSError as e:
+                    # the table still works, it just gets computed again next time
+                    if cls.CACHE_PATH not in cls._unwritable_folders:
+                        cls._unwritable_folders.add(cls.CACHE_PATH)
+                        warnings.warn(
+                            f'could not save thermal tables in {cls.CACHE_PATH} ({e.strerror}); '
+                            f'point ThermalTable.CACHE_PATH somewhere writable to keep them')
+            return ret
+
+        return cls.cache.get_or_compute(digest, load_or_compute)
+
+    @staticmethod
+    def grid_digest(energy_edges: np.ndarray, temperatures: np.ndarray, key_extra: tuple=()) -> str:
+        h = hashlib.sha1()
+        for arr in (energy_edges, temperatures):
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+            h.update(b'|')
+        h.update(repr(key_extra).encode())
+        return h.hexdigest()
+
+    def save(self, path: str):
+        with atomic_write(path, '.npz') as tmp:
+            np.savez(tmp, energy_edges=self.energy_edges, temperatures=self.temperatures, emission=self.emission)
+
+    @classmethod
+    def load(cls, path: str) -> 'ThermalTable':
+        with np.load(path) as data:
+            return cls(data['energy_edges'], data['temperatures'], data['emission'])
+
+    def covers(self, plasma_temps: np.ndarray) -> np.ndarray:
+        ''' which temperatures (MK) are inside the table '''
+        plasma_temps = np.asarray(plasma_temps)
+        return (plasma_temps >= self.temperatures[0]) & (plasma_temps <= self.temperatures[-1])
+
+    def __call__(self, plasma_temps: np.ndarray, emission_measures: np.ndarray) -> np.ndarray:
+        '''
+        (K, energy bins) thermal spectra for K temperatures (MK) and emission measures (cm-3).
+        '''
+        plasma_temps = np.atleast_1d(np.asarray(plasma_temps, dtype=np.float64))
+        if not np.all(self.covers(plasma_temps)):
+            raise ValueError(
+                f'temperatures must be within the table, '
+                f'{self.temperatures[0]:.3g} to {self.temperatures[-1]:.3g} MK')
+        log_t = np.log(plasma_temps)
+        idx = np.clip(np.searchsorted(self._log_t, log_t) - 1, 0, self._log_t.size - 2)
+        frac = ((log_t - self._log_t[idx]) / (self._log_t[idx + 1] - self._log_t[idx]))[:, None]
+        log_emission = (1 - frac) * self._log_emission[idx] + frac * self._log_emission[idx + 1]
+        ret = np.exp(log_emission) * np.reshape(emission_measures, (-1, 1))
+        ret[:, self.zero_bins] = 0
+        return ret
@@ -0,0 +1,137 @@
+'''
+Find the thinnest attenuator which keeps a detector's count rate under a limit.
+
+Write R0 for the stack response with no material transmission (detector
+absorption and dispersion only). The band rate of flare f with the attenuator
+at thickness t is
+    rate(t) = sum_j f_j * (R0.T @ band)_j * <exp(-tau_others - t * tau_att)>_j
+where <...>_j is the average across bin j and tau_att is the attenuator's
+optical depth for 1 cm. R0 and both optical depths only get worked out once,
+on fixed quadrature nodes, so every trial thickness is one exp and a dot product.
+The rate goes down monotonically with t, so the minimal thickness is a
+one-dimensional root to bracket and shrink.
+'''
+import numpy as np
+
+from . import folding
+from . import transmission
+from .AttenuationData import AttenuationType
+from .DetectorStack import DetectorStack
+
+DEFAULT_MAX_THICKNESS = 1.0     # cm
+DEFAULT_XTOL = 1e-6             # cm
+DEFAULT_POINTS_PER_STEP = 16
+DEFAULT_ORDER = 16
+
+
+class BandRateModel:
+    '''
+    Band count rates of some flares as a function of one layer's thickness,
+    with everything else in the stack held fixed.
+    '''
+    def __init__(
+            self, stack: DetectorStack, flare_spectra: list, band: tuple, area: float=None,
+            layer: int=0, disperse_energy: bool=True,
+            attenuations: list=AttenuationType.ALL, order: int=DEFAULT_ORDER):
+        '''
+        flare_spectra: FlareSpectrum objects on the same energy edges.
+        band: (low, high) keV; a bin counts if its lower edge is inside (see `folding.band_matrix`).
+        area: multiplies the rates (cm2); defaults to the stack area.
+        order: Gauss-Legendre points per bin piece for the transmission averages.
+        '''
+        edges = flare_spectra[0].energy_edges
+        if any(not np.array_equal(fs.energy_edges, edges) for fs in flare_spectra):
+            raise ValueError('all flare spectra need the same energy edges')
+
+        bare = self._bare_response(stack, flare_spectra[0], disperse_energy, attenuations)
+        area = stack.area if area is None else area
+        to_rate = folding.rate_matrix(bare, edges, [band], area)[:, 0]
+        bin_weights = np.array([fs.flare for fs in flare_spectra]) * to_rate
+
+        attenuator = stack.materials[layer]
+        others = stack.materials[:layer] + stack.materials[layer+1:]
+        unit_depth = attenuator.optical_depth(attenuations, thickness=1.0)
+        other_depth = sum(
+            (m.optical_depth(attenuations) for m in others), transmission.OpticalDepth())
+
+        breakpoints = (unit_depth + other_depth).breakpoints
+        nodes, weights, owner = transmission.bin_quadrature(edges, breakpoints, order)
+        if stack.fuse_optical_depth:
+            # same as the stack: one transmission for the summed optical depth
+            weights = weights * np.exp(-other_depth(nodes.ravel())).reshape(nodes.shape)
+        else:
+            fixed = DetectorStack(others, stack.photon_detector, False)
+            weights = weights * fixed._generate_material_transmission(flare_spectra[0], attenuations)[owner, None]
+
+        coefficients = (bin_weights[:, owner, None] * weights).reshape(len(flare_spectra), -1)
+        # nodes which can't add any counts don't need to be evaluated
+        keep = np.any(coefficients != 0, axis=0)
+        self.coefficients = coefficients[:, keep]
+        self.unit_tau = unit_depth(nodes.ravel()[keep])
+
+    @staticmethod
+    def _bare_response(stack: DetectorStack, incident_spectrum, disperse_energy: bool, attenuations: list):
+        ''' response without any material transmission: every layer at zero thickness '''
+        thicknesses = [m.thickness for m in stack.materials]
+        for m in stack.materials:
+            m.thickness = 0
+        try:
+            return stack.generate_response_operator(incident_spectrum, disperse_energy, attenuations)
+        finally:
+            for (m, t) in zip(stack.materials, thicknesses):
+                m.thickness = t
+
+    def __call__(self, thicknesses: np.ndarray, which: np.ndarray=None) -> np.ndarray:
+        '''
+        rates (counts/s) of flares `which` (default: all of them) at thicknesses (cm).
+        thicknesses: (flares, M) block, row k being the thicknesses to try for flare which[k].
+        returns: (flares, M) rates.
+        '''
+        coefficients = self.coefficients if which is None else self.coefficients[which]
+        thicknesses = np.asarray(thicknesses, dtype=np.float64)
+        return np.einsum(
+            'kp,kmp->km', coefficients,
+            np.exp(-thicknesses[:, :, None] * self.unit_tau))
+
+
+def minimal_thicknesses(
+        stack: DetectorStack, flare_spectra: list, cps_limit: float, band: tuple,
+        area: float=None, layer: int=0, disperse_energy: bool=True,
+        attenuations: list=AttenuationType.ALL,
+        max_thickness: float=DEFAULT_MAX_THICKNESS, xtol: float=DEFAULT_XTOL,
+        points_per_step: int=DEFAULT_POINTS_PER_STEP, order: int=DEFAULT_ORDER) -> np.ndarray:
+    '''
+    Smallest thickness (cm) of stack.materials[layer] so that each flare gives at
+    most `cps_limit` counts/s in `band` = (low, high) keV.
+    The answer is bracketed in [0, max_thickness] and every step tries
+    `points_per_step` thicknesses inside each bracket, for all flares at once,
+    until the brackets are narrower than xtol.
+    See `BandRateModel` for the rest of the arguments.
+    returns: thickness per flare; the upper end of its final bracket, so it is on
+        the safe side. 0 if no attenuator is needed and NaN if even max_thickness
+        isn't enough.
+    '''
+    model = BandRateModel(stack, flare_spectra, band, area, layer, disperse_energy, attenuations, order)
+
+    num = len(flare_spectra)
+    lo = np.zeros(num)
+    hi = np.full(num, float(max_thickness))
+    ends = model(np.column_stack((lo, hi)))
+    lo_ok = ends[:, 0] <= cps_limit
+    hi_ok = ends[:, 1] <= cps_limit
+    hi[lo_ok] = 0
+
+    active = ~lo_ok & hi_ok
+    fractions = np.arange(1, points_per_step + 1) / (points_per_step + 1)
+    while np.any(active := active & (hi - lo > xtol)):
+        lo_a, hi_a = lo[active], hi[active]
+        trial = lo_a[:, None] + (hi_a - lo_a)[:, None] * fractions
+        ok = model(trial, active) <= cps_limit
+        # rates drop with thickness: the first trial under the limit is the new upper end
+        first = np.where(ok.any(axis=1), ok.argmax(axis=1), points_per_step)
+        grid = np.column_stack((lo_a, trial, hi_a))
+        lo[active] = grid[np.arange(first.size), first]
+        hi[active] = grid[np.arange(first.size), first + 1]
+
+    hi[~lo_ok & ~hi_ok] = np.nan
+    return hi
@@ -0,0 +1,136 @@
+'''
+Small in-process caches shared by the simulation pieces,
+and a safe way to write the ones that go on disk.
+'''
+import collections
+import contextlib
+import hashlib
+import os
+import sys
+import threading
+
+import numpy as np
+from scipy import sparse
+
+
+def array_digest(arr: np.ndarray) -> str:
+    ''' hash of an array's contents, for use in cache keys '''
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1(str((arr.dtype.str, arr.shape)).encode())
+    h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def key_digest(key) -> str:
+    ''' hash of a cache key made of plain values (numbers, strings, tuples), e.g. for file names '''
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def user_cache_dir(*parts: str) -> str:
+    ''' folder under the user's cache directory ($XDG_CACHE_HOME, else ~/.cache)/adetsim '''
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'adetsim', *parts)
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, suffix: str=''):
+    '''
+    Write a file which other threads and processes may be reading:
+
+        with atomic_write(path, '.npz') as tmp:
+            np.savez(tmp, ...)
+
+    gives a temporary name next to `path` to write to, which replaces `path` in one go
+    when the block ends (so nobody ever sees half a file) and is removed if it fails.
+    suffix: ending of the temporary name, for writers which add an extension otherwise.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}'
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _size_of(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        return sum(getattr(value, a).nbytes for a in ('data', 'indices', 'indptr') if hasattr(value, a))
+    return sys.getsizeof(value)
+
+
+class LruCache:
+    '''
+    Dictionary-like cache which evicts the least recently used entries
+    once it holds more than `max_entries` items or, if `max_bytes` is given,
+    once the values take up more memory than that.
+    Keeps hit/miss counts so you can see if it is doing anything.
+    '''
+    def __init__(self, max_entries: int=128, max_bytes: int=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()
+        self._sizes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._sizes.pop(key)
+        self._data[key] = value
+        self._data.move_to_end(key)
+        self._sizes[key] = _size_of(value)
+        self.nbytes += self._sizes[key]
+        self._evict()
+
+    def _evict(self):
+        def too_big():
+            over_budget = self.max_bytes is not None and self.nbytes > self.max_bytes
+            return len(self._data) > self.max_entries or over_budget
+        while self._data and too_big():
+            (key, _) = self._data.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+
+    def get_or_compute(self, key, compute):
+        ''' return the cached value, or compute(), store, and return it '''
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+        self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return (f'<LruCache {len(self)}/{self.max_entries} entries, {self.nbytes} bytes, '
+                f'{self.hits} hits, {self.misses} misses>')
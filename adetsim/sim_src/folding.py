@@ -0,0 +1,86 @@
+'''
+Fold many incident spectra through one detector response at once.
+'''
+import numpy as np
+
+from .ResponseOperator import ResponseOperator, DenseResponse
+
+DEFAULT_CHUNK_SIZE = 4096
+# responses up to this many bins get written out densely for batches,
+# since one multithreaded matrix product beats a sparse or matrix-free apply per chunk
+MAX_DENSE_BINS = 8192
+
+
+def band_matrix(energy_edges: np.ndarray, bands) -> np.ndarray:
+    '''
+    (number of bins, number of bands) matrix: column b holds the widths of the
+    bins in band b = (low, high) keV and zero elsewhere, so that
+    (spectrum in counts/keV) @ band_matrix gives the counts in each band.
+    Like the scripts, a bin belongs to a band if its lower edge is within [low, high].
+    '''
+    energy_edges = np.asarray(energy_edges, dtype=np.float64)
+    lower, widths = energy_edges[:-1], np.diff(energy_edges)
+    ret = np.zeros((widths.size, len(bands)))
+    for (b, (low, high)) in enumerate(bands):
+        inside = (lower >= low) & (lower <= high)
+        ret[inside, b] = widths[inside]
+    return ret
+
+
+def rate_matrix(response, energy_edges: np.ndarray, bands, area: float=1.0) -> np.ndarray:
+    '''
+    (number of bins, number of bands) matrix taking incident spectra straight to
+    band rates: spectra @ rate_matrix == (spectra @ response.T) @ band_matrix * area.
+    '''
+    if not isinstance(response, ResponseOperator):
+        response = DenseResponse(np.asarray(response))
+    return response.T.apply(band_matrix(energy_edges, bands) * area)
+
+
+def fold_spectra(
+        response, spectra: np.ndarray, energy_edges: np.ndarray,
+        bands=(), area: float=1.0, keep_counts: bool=True,
+        chunk_size: int=DEFAULT_CHUNK_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Put every row of `spectra` through `response`.
+    response: ResponseOperator or N x N matrix.
+    spectra: (T, N) block, one incident spectrum per row (e.g. per time bin),
+        in photon / (s cm2 keV). A single (N,) spectrum works too.
+    bands: (low, high) keV pairs to integrate the folded spectra over.
+    area: multiplies the band rates, e.g. the detector area in cm2.
+    keep_counts: if False, skip the (T, N) folded spectra and only work out the
+        rates, which is a single (T, N) @ (N, bands) product per chunk.
+    chunk_size: number of rows folded per matrix product, to bound the temporaries.
+        Responses with at most MAX_DENSE_BINS bins get written out once and each
+        chunk is a single dense (BLAS) product.
+    returns: (counts, rates). counts is the (T, N) block of folded spectra (None
+        if not kept) and rates is (T, len(bands)), in counts/s (per cm2 if area is 1).
+    '''
+    spectra = np.asarray(spectra, dtype=np.float64)
+    single = spectra.ndim == 1
+    spectra = np.atleast_2d(spectra)
+    dense_enough = keep_counts and spectra.shape[0] > 1 and spectra.shape[1] <= MAX_DENSE_BINS
+    if not isinstance(response, ResponseOperator) or dense_enough:
+        response = DenseResponse(np.asarray(response))
+
+    num = spectra.shape[0]
+    counts = np.empty(spectra.shape) if keep_counts else None
+    if keep_counts:
+        bands_to_rates = band_matrix(energy_edges, bands) * area
+    else:
+        bands_to_rates = rate_matrix(response, energy_edges, bands, area)
+    rates = np.empty((num, bands_to_rates.shape[1]))
+
+    for start in range(0, num, chunk_size):
+        chunk = spectra[start:start + chunk_size]
+        if keep_counts:
+            # rows are spectra, so fold as (response @ chunk.T).T
+            folded = response.apply(chunk.T).T
+            counts[start:start + chunk_size] = folded
+            rates[start:start + chunk_size] = folded @ bands_to_rates
+        else:
+            rates[start:start + chunk_size] = chunk @ bands_to_rates
+
+    if single:
+        return (None if counts is None else counts[0]), rates[0]
+    return counts, rates
@@ -0,0 +1,148 @@
+'''
+Streaming pipeline from a GOES flux time series to detector count rates.
+Every stage is a generator working on one chunk of samples at a time,
+so memory stays bounded no matter how long the time series is:
+
+    read_flux_chunks -> spectra_batches -> fold_batches
+
+`count_rates` chains them together and reports the throughput.
+'''
+import itertools
+import time
+from typing import Callable, Iterator
+
+import numpy as np
+
+from . import folding
+from .FlareSpectrum import FlareSpectrum
+
+DEFAULT_CHUNK_SIZE = 2048
+
+
+def battaglia_spectra(fluxes: np.ndarray, energy_edges: np.ndarray) -> np.ndarray:
+    '''
+    (K, N) block of thermal + nonthermal spectra, Battaglia-scaled to each GOES flux (W/m2).
+    Non-finite or non-positive fluxes (data gaps) give rows of NaN.
+    '''
+    ret = np.full((fluxes.size, energy_edges.size - 1), np.nan)
+    valid = np.isfinite(fluxes) & (fluxes > 0)
+    if np.any(valid):
+        ret[valid] = FlareSpectrum.make_batch_with_battaglia_scaling(fluxes[valid], energy_edges).flare
+    return ret
+
+
+def read_flux_chunks(
+        source: str, chunk_size: int=DEFAULT_CHUNK_SIZE,
+        time_column: int=0, flux_column: int=1,
+        delimiter: str=',', skip_header: int=1) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    '''
+    Yield (times, fluxes) chunks of a GOES flux time series.
+    .npy files are memory mapped: either a 1D array of fluxes (the times are then
+    the sample indices) or a 2D array with the times and fluxes in the given columns.
+    Anything else is read as delimited text (CSV), `chunk_size` lines at a time;
+    times come back as strings, unparsed. Unreadable fluxes become NaN.
+    '''
+    if source.endswith('.npy'):
+        data = np.load(source, mmap_mode='r')
+        for start in range(0, data.shape[0], chunk_size):
+            chunk = np.asarray(data[start:start + chunk_size])
+            if chunk.ndim == 1:
+                yield np.arange(start, start + chunk.size), chunk.astype(np.float64)
+            else:
+                yield chunk[:, time_column], chunk[:, flux_column].astype(np.float64)
+        return
+
+    with open(source, 'r') as f:
+        lines = itertools.islice(f, skip_header, None)
+        while True:
+            raw = list(itertools.islice(lines, chunk_size))
+            if not raw:
+                return
+            block = [line.rstrip('\n').split(delimiter) for line in raw]
+            block = [row for row in block if len(row) > max(time_column, flux_column)]
+            if not block:
+                # only blank or short lines in this chunk; there may be more after it
+                continue
+            times = np.array([row[time_column].strip() for row in block])
+            fluxes = np.array([_to_float(row[flux_column]) for row in block])
+            yield times, fluxes
+
+
+def _to_float(s: str) -> float:
+    try:
+        return float(s)
+    except ValueError:
+        return np.nan
+
+
+def spectra_batches(
+        flux_chunks, energy_edges: np.ndarray,
+        make_spectra: Callable=battaglia_spectra) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    ''' turn (times, fluxes) chunks into (times, (K, N) spectra) batches '''
+    for (times, fluxes) in flux_chunks:
+        yield times, make_spectra(np.asarray(fluxes, dtype=np.float64), energy_edges)
+
+
+def fold_batches(
+        batches, response, energy_edges: np.ndarray,
+        bands, area: float=1.0) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    '''
+    fold (times, spectra) batches through a precomputed response.
+    yields (times, (K, len(bands)) count rates); see `folding.rate_matrix`.
+    '''
+    to_rates = folding.rate_matrix(response, energy_edges, bands, area)
+    for (times, spectra) in batches:
+        yield times, spectra @ to_rates
+
+
+class Throughput:
+    ''' keeps track of how many samples went by how fast '''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.samples = 0
+        self.chunks = 0
+
+    def update(self, num_samples: int):
+        self.samples += num_samples
+        self.chunks += 1
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    @property
+    def rate(self) -> float:
+        ''' samples per second '''
+        return self.samples / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return f'{self.samples} samples in {self.chunks} chunks, {self.elapsed:.1f} s ({self.rate:.0f} samples/s)'
+
+
+def count_rates(
+        source: str, response, energy_edges: np.ndarray, bands,
+        area: float=1.0, chunk_size: int=DEFAULT_CHUNK_SIZE,
+        make_spectra: Callable=battaglia_spectra,
+        report: Callable=print, report_every: int=100,
+        throughput: Throughput=None, **read_kwargs) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    '''
+    Stream count rates for a whole GOES flux time series.
+    source: file for `read_flux_chunks` (CSV or .npy), or an iterable of (times, fluxes) chunks.
+    response: precomputed response (ResponseOperator or matrix) on energy_edges,
+        e.g. the dispersed response of a simulated HafxSimulationContainer.
+    bands: (low, high) keV bands to get count rates in.
+    area: detector area (cm2) to scale the rates by.
+    yields: (times, (chunk size, len(bands)) count rates) for each chunk.
+    report: called with the Throughput every `report_every` chunks and at the end;
+        None to stay quiet. Pass your own `throughput` to look at it afterwards.
+    '''
+    flux_chunks = read_flux_chunks(source, chunk_size, **read_kwargs) if isinstance(source, str) else source
+    throughput = throughput or Throughput()
+    batches = spectra_batches(flux_chunks, energy_edges, make_spectra)
+    for (times, rates) in fold_batches(batches, response, energy_edges, bands, area):
+        throughput.update(len(times))
+        if report is not None and throughput.chunks % report_every == 0:
+            report(throughput)
+        yield times, rates
+    if report is not None and throughput.chunks % report_every != 0:
+        report(throughput)
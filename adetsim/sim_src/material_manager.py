@@ -1,27 +1,74 @@
+import collections
+import concurrent.futures
+import contextlib
 import copy
+import hashlib
 import os
-import requests
+import threading
+try:
+    import fcntl
+except ImportError:
+    # no flock (Windows): only threads of one process get kept apart
+    fcntl = None
 
 import astropy.units as u
-import asdf
 import numpy as np
 
 from . import material_constants as mcon
+from .caching import LruCache, atomic_write
+from .LazyModule import LazyModule
+
+# only needed to read or fetch element files which aren't packed
+asdf = LazyModule('asdf')
+requests = LazyModule('requests')
 
 CACHE_PATH = os.path.join(
     os.path.dirname(__file__),
     'element_cache'
 )
 FILE_FMT = os.path.join(CACHE_PATH, '{elt}.asdf')
+# every cached element in one memory-mappable file; see `pack_element_cache`
+PACKED_FILE = os.path.join(CACHE_PATH, 'elements.packed')
+PACKED_MAGIC = b'ADETELT1'
+PACKED_COLUMNS = (
+    ('energy', u.MeV), ('photoelectric', u.cm**2 / u.g),
+    ('compton', u.cm**2 / u.g), ('rayleigh', u.cm**2 / u.g))
+
+# NIST lists absorption edge energies twice; we pull the copies apart by this much
+EDGE_NUDGE = 1e-10 << u.MeV
+
+# data loaded so far in this process: elements by name, compounds by normalized formula,
+# both along with the digests of the element data (so refreshed data gets loaded again).
+# everything in here is read-only; see hits / misses / hit_rate for how well they work.
+element_cache = LruCache(max_entries=128)
+compound_cache = LruCache(max_entries=64)
 
 
 def fetch_element(element_name: str) -> dict[str, u.Quantity]:
+    '''
+    Energy and attenuation coefficients of an element, as read-only Quantities.
+    Loaded once per process (packed file, else asdf cache, else NIST) and
+    looked up in `element_cache` after that, until the local data changes.
+    The dict is new on every call.
+    '''
     element_name = element_name.title()
     if element_name not in mcon.elements:
         raise ValueError(f'no data is available for {element_name} from NIST')
+    key = (element_name, element_source_digest(element_name, fetch=True))
+    return dict(element_cache.get_or_compute(key, lambda: _load_element(element_name)))
 
-    file_name = download_save_nist(element_name)
-    return load_element_data(file_name)
+
+def _load_element(element_name: str) -> dict[str, u.Quantity]:
+    data = packed_element_data(element_name)
+    if data is None:
+        data = load_element_data(download_save_nist(element_name))
+    return _read_only(data)
+
+
+def _read_only(data: dict) -> dict:
+    for v in data.values():
+        v.flags.writeable = False
+    return data
 
 
 def fetch_compound(formula: dict[str, float]) -> dict[str, dict[str, u.Quantity]]:
@@ -35,45 +82,115 @@ def fetch_compound(formula: dict[str, float]) -> dict[str, dict[str, u.Quantity]
     
     Doping can also be handled.
     Example for GAGG(Ce):      {'Gd': 2.95, 'Ce': 0.05, 'Al': 2, 'Ga': 3, 'O': 12}
+
+    The arrays are read-only and shared (see `compound_cache`); the dicts are new
+    on every call, and `formula` isn't changed.
     '''
+    normalized = normalize_formula(formula)
+    key = (normalized, tuple(element_source_digest(e, fetch=True) for (e, _) in normalized))
+    cached = compound_cache.get_or_compute(key, lambda: _weigh_compound(formula))
+    return {k: dict(v) for (k, v) in cached.items()}
+
+
+def _weigh_compound(formula: dict[str, float]) -> dict[str, dict[str, u.Quantity]]:
     masses = dict()
     coeffs = dict()
     for (element, num) in formula.items():
         element = element.title()
         coeffs[element] = fetch_element(element)
-        masses[element] = num * mcon.atomic_masses[mcon.elements[element]]
+        masses[element] = masses.get(element, 0) + num * mcon.atomic_masses[mcon.elements[element]]
 
     total_mass = sum(masses.values())
     scaled_masses = {k: (v / total_mass) for (k, v) in masses.items()}
     ret = dict()
     for (elt, m) in scaled_masses.items():
         ret_key = f'{elt}_{m:0.2f}'
-
-        # Do not scale this
-        energy = coeffs[elt].pop('energy')
-        ret[ret_key] = {k: (v * m) for (k, v) in coeffs[elt].items()}
-        ret[ret_key]['energy'] = energy
+        # Do not scale the energy
+        ret[ret_key] = _read_only({
+            k: (v if k == 'energy' else v * m) for (k, v) in coeffs[elt].items()})
     return ret
 
 
-def download_save_nist(name: str) -> str:
+def cache_info() -> dict[str, dict[str, float]]:
+    ''' hits, misses and hit rates of the element and compound caches '''
+    return {
+        name: {'hits': cache.hits, 'misses': cache.misses, 'hit_rate': cache.hit_rate}
+        for (name, cache) in (('element', element_cache), ('compound', compound_cache))
+    }
+
+
+def normalize_formula(formula: dict[str, float]) -> tuple[tuple[str, float], ...]:
+    '''
+    Hashable, canonical version of a compound formula.
+    Only the relative amounts matter for mass attenuation,
+    so e.g. {'h': 2, 'O': 1} and {'H': 4, 'O': 2} are the same.
+    '''
+    amounts = dict()
+    for (element, num) in formula.items():
+        element = element.title()
+        amounts[element] = amounts.get(element, 0) + num
+    total = sum(amounts.values())
+    return tuple(sorted((k, round(v / total, 12)) for (k, v) in amounts.items()))
+
+
+# Data request URL from XCOM
+XCOM_URL = 'https://physics.nist.gov/cgi-bin/Xcom/data.pl'
+TIMEOUT = 60    # s
+
+
+def post_form(url: str, form_data: dict) -> str:
+    ''' default transport: POST the form, return the reply text '''
+    resp = requests.post(url, data=form_data, timeout=TIMEOUT)
+    resp.raise_for_status()
+    return resp.text
+
+
+# how element data gets fetched: transport(url, form data) -> reply text.
+# swap it (or XCOM_URL) out to work against a local server
+nist_transport = post_form
+DEFAULT_PREFETCH_WORKERS = 8
+
+
+def download_save_nist(name: str, transport=None) -> str:
     '''
     Request photoelectric, incoherent, coherent scattering data from NIST XCOM program.
     Return the resulting file name
+    Safe to call from several threads or processes at once: only one of them
+    downloads (under a lock file) and the file appears in one piece (temp file + rename).
+    transport: overrides the module-level `nist_transport`.
     '''
     elt_file = FILE_FMT.format(elt=name)
     if os.path.exists(elt_file):
         # Have data already
         return elt_file
-    print(f'{name} has no local data; downloading')
-    if not os.path.exists(CACHE_PATH):
-        os.mkdir(CACHE_PATH)
+    os.makedirs(CACHE_PATH, exist_ok=True)
+
+    with _file_lock(f'{elt_file}.lock'):
+        # someone else may have got it while we waited
+        if os.path.exists(elt_file):
+            return elt_file
+        print(f'{name} has no local data; downloading')
+        text = (transport or nist_transport)(XCOM_URL, _xcom_form(name))
+        try:
+            data = decode_nist_response(text)
+        except ValueError:
+            raise ValueError(
+                "Issue decoding NIST output. Make sure your values are OK."
+                "NIST response was:\n"
+                + text
+            )
 
+        with atomic_write(elt_file) as tmp, _asdf_lock:
+            asdf.AsdfFile(data).write_to(tmp)
+    return elt_file
+
+
+def _xcom_form(name: str) -> dict:
     atomic_number = mcon.elements[name]
     # Low/high energy bounds in MeV.
     # Should cover most use cases... ;)
     low, high = 0.0001, 10000
-    form_dat = {
+    return {
         'character': 'space',
         'Method': '1',
         'ZNum': atomic_number,
@@ -87,21 +204,59 @@ def download_save_nist(name: str) -> str:
         'incoherent': 'on'
     }
 
-    # Data request URL from XCOM
-    element_url = 'https://physics.nist.gov/cgi-bin/Xcom/data.pl'
-    resp = requests.post(element_url, data=form_dat)
-    try:
-        data = decode_nist_response(resp.text)
-    except ValueError:
-        raise ValueError(
-            "Issue decoding NIST output. Make sure your values are OK."
-            "NIST response was:\n"
-            + resp.text
-        )
 
-    out = asdf.AsdfFile(data)
-    out.write_to(elt_file)
-    return elt_file
+def prefetch_elements(formulas, max_workers: int=DEFAULT_PREFETCH_WORKERS, transport=None) -> list[str]:
+    '''
+    Make sure every element of the given formulas is available locally,
+    downloading the missing ones concurrently (at most max_workers at a time).
+    formulas: compound dicts like for `fetch_compound`, and/or element names.
+    Return the names of the elements which had to be downloaded.
+    '''
+    wanted = set()
+    for f in formulas:
+        wanted.update(e.title() for e in ([f] if isinstance(f, str) else f))
+    unknown = wanted - set(mcon.elements)
+    if unknown:
+        raise ValueError(f'no data is available for {sorted(unknown)} from NIST')
+
+    missing = sorted(
+        e for e in wanted
+        if not os.path.exists(FILE_FMT.format(elt=e)) and packed_element_data(e) is None)
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # list() so that the first failure gets raised here
+            list(pool.map(lambda e: download_save_nist(e, transport), missing))
+    return missing
+
+
+# locks held by this process; flock is per open file, so threads need their own lock too
+_thread_locks = collections.defaultdict(threading.Lock)
+_thread_locks_guard = threading.Lock()
+# asdf sets up its type converters lazily and not thread-safely; the downloads still overlap
+_asdf_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    '''
+    exclusive lock between threads and processes, held while inside the with block.
+    The lock file is removed on the way out (while still locked), so whoever was
+    already waiting gets the lock next and has to re-check what it waited for.
+    '''
+    with _thread_locks_guard:
+        thread_lock = _thread_locks[os.path.abspath(path)]
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def decode_nist_response(txt: str) -> dict[str, u.Quantity]:
@@ -118,7 +273,7 @@ def decode_nist_response(txt: str) -> dict[str, u.Quantity]:
     energy, ray, comp, photo = np.array(list(reversed(data))).T
     # Some absorption edges have two energy values really close
     # Make them a little further apart for numerics
-    eps = 1e-10
+    eps = EDGE_NUDGE.to_value(u.MeV)
     for i in range(energy.size-1):
         if np.abs(energy[i] - energy[i+1]) < eps:
             energy[i+1] += eps
@@ -130,8 +285,140 @@ def decode_nist_response(txt: str) -> dict[str, u.Quantity]:
     }
 
 
+def find_absorption_edges(energy: u.Quantity) -> u.Quantity:
+    '''
+    Absorption edge energies of an element's NIST energy grid.
+    These are the points which `decode_nist_response` nudged apart.
+    '''
+    close = np.diff(energy) <= 2 * EDGE_NUDGE
+    return energy[:-1][close]
+
+
 def load_element_data(fn: str) -> dict[str, u.Quantity]:
     # Keys we wanna keep from the data file
     keep = ['energy', 'photoelectric', 'compton', 'rayleigh']
     with asdf.open(fn) as f:
         return {k: copy.deepcopy(f[k]) for k in keep}
+
+
+def pack_element_cache(out_file: str=None) -> str:
+    '''
+    Pack every element in the cache (Z = 1 ... 100) into one file which
+    `fetch_element` memory maps, so nothing has to be downloaded or opened one
+    element at a time afterwards. Rerun it after refreshing the NIST data.
+    Layout (little endian):
+        8 bytes                  PACKED_MAGIC
+        int64                    largest Z
+        int64[largest Z + 1]     offsets: element Z is columns offsets[Z-1]:offsets[Z] (empty if not cached)
+        float64[4, offsets[-1]]  energy (MeV), photoelectric, compton, rayleigh (cm2/g)
+    Return the file name.
+    '''
+    out_file = out_file or PACKED_FILE
+    max_z = max(mcon.elements.values())
+    names = {z: name for (name, z) in mcon.elements.items()}
+    lengths = np.zeros(max_z, dtype=np.int64)
+    blocks = []
+    for z in range(1, max_z + 1):
+        elt_file = FILE_FMT.format(elt=names[z])
+        if not os.path.exists(elt_file):
+            continue
+        data = load_element_data(elt_file)
+        blocks.append([data[k].to_value(unit) for (k, unit) in PACKED_COLUMNS])
+        lengths[z - 1] = data['energy'].size
+
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    table = np.concatenate(blocks, axis=1) if blocks else np.empty((len(PACKED_COLUMNS), 0))
+    with atomic_write(out_file) as tmp, open(tmp, 'wb') as f:
+        f.write(PACKED_MAGIC)
+        f.write(np.array([max_z], dtype='<i8').tobytes())
+        f.write(offsets.astype('<i8').tobytes())
+        f.write(np.ascontiguousarray(table, dtype='<f8').tobytes())
+    print(f'packed {np.count_nonzero(lengths)} elements into {out_file}')
+    return out_file
+
+
+def packed_element_data(element_name: str, packed_file: str=None) -> dict[str, u.Quantity]:
+    '''
+    Element data out of the packed file, as read-only views of the memory map
+    (no copies). None if there is no packed file or the element isn't in it.
+    '''
+    columns = _packed_columns(element_name, packed_file)
+    if columns is None:
+        return None
+    return {k: columns[i] << unit for (i, (k, unit)) in enumerate(PACKED_COLUMNS)}
+
+
+def _packed_columns(element_name: str, packed_file: str=None) -> np.ndarray:
+    ''' (PACKED_COLUMNS, points) block of an element in the packed file, or None '''
+    packed_file = packed_file or PACKED_FILE
+    if not os.path.exists(packed_file):
+        return None
+    offsets, table = _open_packed(packed_file)
+    z = mcon.elements[element_name.title()]
+    if z >= offsets.size or offsets[z - 1] == offsets[z]:
+        return None
+    return table[:, offsets[z - 1]:offsets[z]]
+
+
+def element_source_digest(element_name: str, fetch: bool=False) -> str:
+    '''
+    sha1 of the data `fetch_element` loads for an element: its block of the
+    packed file if it is in there, else its asdf file.
+    Changes whenever the NIST data gets refreshed (or repacked), so it can go
+    into the keys of anything worked out from the element data.
+    If there is no local data for it yet, returns None, or with fetch, downloads
+    it first (so a key made now still matches once the data is there).
+    '''
+    element_name = element_name.title()
+    if element_name not in mcon.elements:
+        if fetch:
+            raise ValueError(f'no data is available for {element_name} from NIST')
+        return None
+    digest = _local_digest(element_name)
+    if digest is None and fetch:
+        download_save_nist(element_name)
+        digest = _local_digest(element_name)
+    return digest
+
+
+def _local_digest(element_name: str) -> str:
+    columns = _packed_columns(element_name)
+    if columns is not None:
+        return hashlib.sha1(np.ascontiguousarray(columns).tobytes()).hexdigest()
+
+    elt_file = FILE_FMT.format(elt=element_name)
+    try:
+        st = os.stat(elt_file)
+    except FileNotFoundError:
+        return None
+    key = (os.path.abspath(elt_file), st.st_mtime_ns, st.st_size)
+    if key not in _file_digests:
+        with open(elt_file, 'rb') as f:
+            _file_digests[key] = hashlib.sha1(f.read()).hexdigest()
+    return _file_digests[key]
+
+
+# (file name, modification time, size) -> sha1 of asdf element files hashed so far
+_file_digests = dict()
+
+
+# (file name, modification time) -> (offsets, table) of the packed file that is open
+_packed_maps = dict()
+
+
+def _open_packed(packed_file: str) -> tuple[np.ndarray, np.ndarray]:
+    key = (os.path.abspath(packed_file), os.stat(packed_file).st_mtime_ns)
+    if key not in _packed_maps:
+        raw = np.memmap(packed_file, dtype=np.uint8, mode='r')
+        if raw[:len(PACKED_MAGIC)].tobytes() != PACKED_MAGIC:
+            raise ValueError(f'{packed_file} is not a packed element file')
+        start = len(PACKED_MAGIC)
+        max_z = int(raw[start:start + 8].view('<i8')[0])
+        start += 8
+        offsets = raw[start:start + 8 * (max_z + 1)].view('<i8')
+        start += 8 * (max_z + 1)
+        table = raw[start:].view('<f8').reshape(len(PACKED_COLUMNS), -1)
+        # a rebuilt file replaces the old one; only keep the newest map around
+        _packed_maps.clear()
+        _packed_maps[key] = (offsets, table)
+    return _packed_maps[key]
@@ -0,0 +1,144 @@
+'''
+Run a function over a grid of parameters (GOES class x attenuator thickness x detector ...)
+on a pool of processes, and collect the results in one indexed store.
+
+    def build(detector):
+        return {'hafx': HafxStack, 'x123': X123Stack}[detector]()
+
+    def evaluate(stack, detector, goes_class, thickness):
+        stack.materials[0].thickness = thickness
+        ...
+        return effective_area
+
+    grid = {'detector': ['hafx', 'x123'], 'goes_class': ['C1', 'M1'], 'thickness': np.linspace(0, 0.05, 50)}
+    results = run_sweep(grid, evaluate, build=build, stack_axes=['detector'], max_workers=32)
+    results.get(detector='hafx', goes_class='M1', thickness=0.01)
+
+Stacks are built once per worker for every distinct value of the `stack_axes`
+and reused for every point that shares them. `build` and `evaluate` are sent to
+the workers so they have to be picklable, i.e. defined at module level.
+With one worker per core, set OMP_NUM_THREADS=1 (or the like for your BLAS)
+before starting Python so the workers don't fight over cores.
+'''
+import concurrent.futures
+import itertools
+import json
+import os
+
+import numpy as np
+
+# per-worker state: what to run and the stacks built so far
+_worker = dict()
+
+
+class SweepResults:
+    '''
+    Results of a sweep, indexed by parameter values.
+    axes: {name: values} in the order of the grid; results are in itertools.product order.
+    '''
+    def __init__(self, axes: dict, values: list):
+        self.axes = {name: list(v) for (name, v) in axes.items()}
+        self.values = list(values)
+        if len(self.values) != int(np.prod(self.shape)):
+            raise ValueError(f'{len(self.values)} results for a grid of shape {self.shape}')
+
+    @property
+    def names(self) -> list:
+        return list(self.axes)
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(len(v) for v in self.axes.values())
+
+    def index_of(self, **point) -> tuple:
+        ''' grid index of a point given by parameter values '''
+        try:
+            return tuple(self.axes[name].index(point[name]) for name in self.names)
+        except KeyError as e:
+            raise KeyError(f'need a value for each of {self.names}') from e
+
+    def get(self, **point):
+        return self[self.index_of(**point)]
+
+    def __getitem__(self, index: tuple):
+        return self.values[int(np.ravel_multi_index(index, self.shape))]
+
+    def points(self):
+        ''' (parameter dict, result) pairs '''
+        for (combo, value) in zip(itertools.product(*self.axes.values()), self.values):
+            yield dict(zip(self.names, combo)), value
+
+    def to_array(self) -> np.ndarray:
+        ''' results stacked into a (grid shape + result shape) array, if they all have the same shape '''
+        return np.stack([np.asarray(v) for v in self.values]).reshape(self.shape + np.shape(self.values[0]))
+
+    def save(self, path: str):
+        ''' .npz with the stacked results and the axes (as JSON, so stick to numbers and strings) '''
+        np.savez(path, values=self.to_array(), axes=json.dumps(_jsonable(self.axes)))
+
+    @classmethod
+    def load(cls, path: str) -> 'SweepResults':
+        with np.load(path) as data:
+            axes = json.loads(str(data['axes']))
+            values = data['values']
+        shape = tuple(len(v) for v in axes.values())
+        return cls(axes, list(values.reshape((-1,) + values.shape[len(shape):])))
+
+    def __repr__(self):
+        return f'<SweepResults over {dict(zip(self.names, self.shape))}>'
+
+
+def _jsonable(axes: dict) -> dict:
+    return {name: [v.item() if isinstance(v, np.generic) else v for v in values] for (name, values) in axes.items()}
+
+
+def run_sweep(
+        grid: dict, evaluate, build=None, stack_axes=(),
+        max_workers: int=None, chunk_size: int=8) -> SweepResults:
+    '''
+    Call evaluate(stack, **point) for every point in the Cartesian product of `grid`.
+    grid: {parameter name: values}. Put the stack axes first so neighbouring points
+        (which go to the same worker in a chunk) share stacks.
+    build: build(**stack params) makes whatever `evaluate` gets as `stack`, once per
+        worker per distinct combination of the `stack_axes` parameters. None passes None.
+    max_workers: processes to use (default: os.cpu_count()). 0 or 1 runs in this process.
+    chunk_size: points handed to a worker at a time.
+    '''
+    names = list(grid)
+    if any(a not in names for a in stack_axes):
+        raise ValueError(f'stack axes {list(stack_axes)} must be among the grid axes {names}')
+    points = [dict(zip(names, combo)) for combo in itertools.product(*grid.values())]
+    chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+
+    if max_workers <= 1:
+        _init_worker(evaluate, build, tuple(stack_axes))
+        results = [_run_chunk(c) for c in chunks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker,
+                initargs=(evaluate, build, tuple(stack_axes))) as pool:
+            results = list(pool.map(_run_chunk, chunks))
+
+    return SweepResults(grid, itertools.chain.from_iterable(results))
+
+
+def _init_worker(evaluate, build, stack_axes: tuple):
+    _worker.clear()
+    _worker.update(evaluate=evaluate, build=build, stack_axes=stack_axes, stacks=dict())
+
+
+def _stack_for(point: dict):
+    if _worker['build'] is None:
+        return None
+    params = {a: point[a] for a in _worker['stack_axes']}
+    key = tuple(params.values())
+    stacks = _worker['stacks']
+    if key not in stacks:
+        stacks[key] = _worker['build'](**params)
+    return stacks[key]
+
+
+def _run_chunk(points: list) -> list:
+    evaluate = _worker['evaluate']
+    return [evaluate(_stack_for(p), **p) for p in points]
@@ -0,0 +1,297 @@
+'''
+Engines which average the transmission probability exp(-tau(E)) across energy bins.
+'''
+import astropy.units as u
+import numpy as np
+from scipy import special
+
+from . import material_manager as mman
+from .LazyModule import LazyModule
+
+# only the (slow, reference) quad engine needs it
+integrate = LazyModule('scipy.integrate')
+
+
+class IntegrationMode:
+    QUAD = 'quad'
+    GAUSS_LEGENDRE = 'gauss-legendre'
+    ANALYTIC = 'analytic'
+    ALL = [QUAD, GAUSS_LEGENDRE, ANALYTIC]
+    DEFAULT = ANALYTIC
+
+
+# the analytic engine needs Gamma(1 - s, tau) with s = -1/b, i.e. 1 - s > 0.
+# stay a bit away from s = 1 and integrate flatter power laws numerically.
+_STEEPEST_NUMERIC_SLOPE = -1.01
+# times power-law tables get their segments halved, at most
+MAX_TABLE_REFINEMENTS = 20
+
+
+def refine_power_law_table(
+        log_f, log_x: np.ndarray, rtol: float,
+        max_refinements: int=MAX_TABLE_REFINEMENTS, splittable=None) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Points of a function which straight lines on the log-log plot (power laws) join
+    to within rtol (relative) at the geometric midpoint of every segment.
+    Starting from log_x, segments which miss get split in half until they match,
+    at most max_refinements times.
+    log_f: log f as a function of log x.
+    splittable: splittable(log_x, log_y) -> mask of the segments which may be split at all.
+    returns: (log x, log f) of the points.
+    '''
+    log_y = log_f(log_x)
+    for _ in range(max_refinements):
+        mid_log_x = (log_x[1:] + log_x[:-1]) / 2
+        mid_log_y = log_f(mid_log_x)
+        chord = (log_y[1:] + log_y[:-1]) / 2
+        bad = np.abs(np.expm1(chord - mid_log_y)) > rtol
+        if splittable is not None:
+            bad &= splittable(log_x, log_y)
+        if not np.any(bad):
+            break
+        order = np.argsort(np.concatenate((log_x, mid_log_x[bad])), kind='stable')
+        log_x = np.concatenate((log_x, mid_log_x[bad]))[order]
+        log_y = np.concatenate((log_y, mid_log_y[bad]))[order]
+    return log_x, log_y
+
+
+class OpticalDepth:
+    '''
+    Optical depth tau(E) = sum of mu_i(E) * rho_i * t_i over some attenuation
+    mechanisms of some material(s). Energies are in keV.
+    Each term is (AttenuationData, AttenuationType, areal density rho * t);
+    add OpticalDepths together to fuse them into a single integration.
+    '''
+    def __init__(self, terms: list=None):
+        # zero-thickness layers don't attenuate anything
+        self.terms = [t for t in (terms or []) if t[2] != 0]
+
+    def __add__(self, other: 'OpticalDepth') -> 'OpticalDepth':
+        return OpticalDepth(self.terms + other.terms)
+
+    @property
+    def cache_key(self) -> tuple:
+        ''' identifies this optical depth (what, which mechanism, how much) in response caches '''
+        return tuple(
+            (att_data.cache_key, att_type, float(areal_density))
+            for (att_data, att_type, areal_density) in self.terms)
+
+    @property
+    def absorption_edges(self) -> np.ndarray:
+        ''' edges of every element in every term (keV), where tau jumps '''
+        return np.unique(np.concatenate(
+            [np.empty(0)] + [att_data.compound_edges for (att_data, _, _) in self.terms]))
+
+    @property
+    def breakpoints(self) -> np.ndarray:
+        ''' where tau is not smooth: both ends of the (nudged) step at each absorption edge '''
+        edges = self.absorption_edges
+        return np.union1d(edges, edges + mman.EDGE_NUDGE.to_value(u.keV))
+
+    def __call__(self, energies: np.ndarray) -> np.ndarray:
+        log_energies = np.log(energies)
+        ret = np.zeros_like(log_energies)
+        for (att_data, att_type, areal_density) in self.terms:
+            ret += np.exp(att_data.log_interpolate(att_type, log_energies)) * areal_density
+        return ret
+
+    def power_law_table(
+            self, rtol: float=1e-9, max_refinements: int=MAX_TABLE_REFINEMENTS) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        (energies, tau) which are joined by power laws between the points.
+        Starts from the union of the terms' tables. A sum of power laws with
+        different slopes is not itself a power law, so steep segments whose
+        geometric midpoint misses the true tau by more than `rtol` (relative)
+        get split until it matches. Flatter segments are left alone because
+        `analytic_bin_average` integrates the true tau over them anyway.
+        See `refine_power_law_table`.
+        '''
+        log_e = np.unique(np.concatenate([
+            att_data.log_log_table(att_type)[0] for (att_data, att_type, _) in self.terms
+        ]))
+        log_e, log_tau = refine_power_law_table(
+            lambda log_e: np.log(self(np.exp(log_e))), log_e, rtol, max_refinements,
+            splittable=lambda log_e, log_tau: np.diff(log_tau) / np.diff(log_e) < _STEEPEST_NUMERIC_SLOPE)
+        return np.exp(log_e), np.exp(log_tau)
+
+
+def bin_averaged_transmission(
+        optical_depth: OpticalDepth, energy_edges: np.ndarray,
+        mode: str=None, scales: np.ndarray=None, **kwargs) -> np.ndarray:
+    '''
+    Average exp(-tau) across each energy bin using the chosen integration mode.
+    Every engine splits bins exactly at absorption edges, so each piece it
+    integrates is smooth. Extra keyword arguments go to the engine.
+
+    scales: optional array of factors applied to tau (e.g. thicknesses, if the
+        optical depth is for 1 cm). The optical depth only gets evaluated once
+        and the result is a (scales.size, number of bins) block.
+    '''
+    engines = {
+        IntegrationMode.QUAD: quad_bin_average,
+        IntegrationMode.GAUSS_LEGENDRE: gauss_legendre_bin_average,
+        IntegrationMode.ANALYTIC: analytic_bin_average,
+    }
+    mode = mode or IntegrationMode.DEFAULT
+    try:
+        engine = engines[mode]
+    except KeyError:
+        raise ValueError(f'unknown integration mode {mode!r}; pick from {IntegrationMode.ALL}')
+
+    block = np.atleast_1d(np.asarray(1.0 if scales is None else scales, dtype=np.float64))
+    energy_edges = np.asarray(energy_edges, dtype=np.float64)
+    if optical_depth.terms:
+        ret = engine(optical_depth, energy_edges, scales=block, **kwargs)
+    else:
+        ret = np.ones((block.size, energy_edges.size - 1))
+    return ret[0] if scales is None else ret
+
+
+def quad_bin_average(
+        optical_depth: OpticalDepth, energy_edges: np.ndarray,
+        scales: np.ndarray=np.ones(1), rtol: float=1.49e-8) -> np.ndarray:
+    ''' reference engine: one adaptive `integrate.quad` call per bin and scale (slow) '''
+    breakpoints = optical_depth.breakpoints
+    ret = np.zeros((scales.size, energy_edges.size - 1))
+    for (j, scale) in enumerate(scales):
+        transm_prob = lambda e: np.exp(-scale * optical_depth(e))
+        for i in range(energy_edges.size - 1):
+            lo, hi = energy_edges[i], energy_edges[i+1]
+            inside = breakpoints[(breakpoints > lo) & (breakpoints < hi)]
+            integrated, _ = integrate.quad(
+                transm_prob, lo, hi, epsrel=rtol, points=inside if inside.size else None)
+            ret[j, i] = integrated / (hi - lo)
+    return ret
+
+
+def gauss_legendre_bin_average(
+        optical_depth: OpticalDepth, energy_edges: np.ndarray,
+        scales: np.ndarray=np.ones(1), order: int=8,
+        rtol: float=1e-8, atol: float=1e-12, max_depth: int=20) -> np.ndarray:
+    '''
+    Fixed-order Gauss-Legendre quadrature over every bin at once.
+    Bins are first split at absorption edges. Each interval's estimate
+    is compared against the sum over its two halves; only the intervals
+    which differ by more than
+        max(rtol * |integral|, atol * width)
+    (for any of the scales) get bisected again, up to `max_depth` times.
+    Like `integrate.quad`, rtol is floored at 50 machine epsilons because
+    rounding noise would otherwise keep every interval splitting.
+    '''
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    rtol = max(rtol, 50 * np.finfo(np.float64).eps)
+
+    def gl(lo, hi):
+        half = (hi - lo) / 2
+        x = (lo + half)[:, None] + half[:, None] * nodes
+        # one vectorized optical depth evaluation for every interval
+        tau = optical_depth(x.ravel()).reshape(x.shape)
+        return half * (np.exp(-scales[:, None, None] * tau) @ weights)
+
+    num_bins = energy_edges.size - 1
+    lo, hi, owner = _split_bins(energy_edges, optical_depth.breakpoints)
+    estimate = gl(lo, hi)
+    integrated = np.zeros((scales.size, num_bins))
+    for depth in range(max_depth + 1):
+        mid = (lo + hi) / 2
+        left, right = gl(lo, mid), gl(mid, hi)
+        refined = left + right
+
+        close = np.abs(refined - estimate) <= np.maximum(rtol * np.abs(refined), atol * (hi - lo))
+        done = np.all(close, axis=0)
+        if depth == max_depth:
+            done[:] = True
+        integrated += _sum_by_bin(refined[:, done], owner[done], num_bins)
+
+        todo = ~done
+        if not np.any(todo):
+            break
+        owner = np.concatenate((owner[todo], owner[todo]))
+        lo, hi = np.concatenate((lo[todo], mid[todo])), np.concatenate((mid[todo], hi[todo]))
+        estimate = np.concatenate((left[:, todo], right[:, todo]), axis=1)
+
+    return integrated / np.diff(energy_edges)
+
+
+def analytic_bin_average(
+        optical_depth: OpticalDepth, energy_edges: np.ndarray,
+        scales: np.ndarray=np.ones(1), order: int=16, table_rtol: float=1e-9) -> np.ndarray:
+    '''
+    Exact bin averages for an optical depth which is a power law
+        tau(E) = tau_k * (E / E_k)**b
+    between the points of `optical_depth.power_law_table()`.
+    Bins get split at the table energies and absorption edges; for each
+    piece with b < -1 (s = -1/b < 1) the antiderivative of exp(-tau) is
+        G(E) = E * (exp(-tau(E)) - tau(E)**s * Gamma(1 - s, tau(E))).
+    The few flatter or rising pieces (the 1e-10 MeV steps at absorption
+    edges, slowly-varying scattering) get a fixed `order`-point
+    Gauss-Legendre sum of the true tau, which is exact to rounding for such
+    smooth integrands.
+    Scaling tau keeps the slopes, so every scale reuses the same pieces.
+    `table_rtol` only matters for fused optical depths; see `OpticalDepth.power_law_table`.
+    '''
+    table_e, table_tau = optical_depth.power_law_table(rtol=table_rtol)
+    log_e, log_tau = np.log(table_e), np.log(table_tau)
+    slopes = np.diff(log_tau) / np.diff(log_e)
+
+    lo, hi, owner = _split_bins(
+        energy_edges, np.union1d(table_e, optical_depth.breakpoints))
+
+    # power law of the table segment each piece falls in (end segments extrapolate)
+    seg = np.clip(np.searchsorted(log_e, np.log((lo + hi) / 2)) - 1, 0, slopes.size - 1)
+    b = slopes[seg]
+
+    def tau_at(e, which):
+        k = seg[which]
+        return scales[:, None] * np.exp(log_tau[k] + b[which] * (np.log(e) - log_e[k]))
+
+    integrated = np.empty((scales.size, lo.size))
+    steep = b < _STEEPEST_NUMERIC_SLOPE
+    s = -1 / b[steep]
+    def antiderivative(e):
+        tau = tau_at(e, steep)
+        return e * (np.exp(-tau) - tau**s * special.gamma(1 - s) * special.gammaincc(1 - s, tau))
+    integrated[:, steep] = antiderivative(hi[steep]) - antiderivative(lo[steep])
+
+    flat = ~steep
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    half = (hi[flat] - lo[flat]) / 2
+    x = (lo[flat] + half)[:, None] + half[:, None] * nodes
+    tau = optical_depth(x.ravel()).reshape(x.shape)
+    integrated[:, flat] = half * (np.exp(-scales[:, None, None] * tau) @ weights)
+
+    summed = _sum_by_bin(integrated, owner, energy_edges.size - 1)
+    return summed / np.diff(energy_edges)
+
+
+def bin_quadrature(
+        energy_edges: np.ndarray, breakpoints: np.ndarray,
+        order: int=16) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Fixed Gauss-Legendre rule for averaging across energy bins which are split at
+    the breakpoints (e.g. `OpticalDepth.breakpoints`). The average of f across bin i is
+        np.bincount(owner, weights=np.sum(weights * f(nodes), axis=1))[i]
+    This is `gauss_legendre_bin_average` without the adaptive refinement, for when
+    the same nodes get reused many times (e.g. for many thicknesses).
+    returns: (nodes, weights, owner); nodes and weights are (pieces, order).
+    '''
+    gl_nodes, gl_weights = np.polynomial.legendre.leggauss(order)
+    lo, hi, owner = _split_bins(energy_edges, breakpoints)
+    half = (hi - lo) / 2
+    nodes = (lo + half)[:, None] + half[:, None] * gl_nodes
+    weights = (half / np.diff(energy_edges)[owner])[:, None] * gl_weights
+    return nodes, weights, owner
+
+
+def _sum_by_bin(values: np.ndarray, owner: np.ndarray, num_bins: int) -> np.ndarray:
+    ''' add up the (scales, pieces) values of the pieces belonging to each bin '''
+    return np.array([np.bincount(owner, weights=v, minlength=num_bins) for v in values]).reshape(-1, num_bins)
+
+
+def _split_bins(energy_edges: np.ndarray, breakpoints: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    ''' split bins at the breakpoints. returns (lower, upper, bin index) of every piece '''
+    inside = (breakpoints > energy_edges[0]) & (breakpoints < energy_edges[-1])
+    points = np.union1d(energy_edges, breakpoints[inside])
+    lo, hi = points[:-1], points[1:]
+    owner = np.searchsorted(energy_edges, lo, side='right') - 1
+    return lo, hi, owner
@@ -4,6 +4,7 @@ from adetsim.sim_src import AttenuationData as ad
 from adetsim.sim_src import DetectorStack as ds
 from adetsim.sim_src import FlareSpectrum as fs
 from adetsim.sim_src import Material as mat
+from adetsim.sim_src import ResponseOperator as ro
 from adetsim.hafx_src import FixedEnergyResolutionDetector as ferd
 from adetsim.hafx_src import HafxMaterialProperties as hmp
 
@@ -57,12 +58,12 @@ class GripsStack(ds.DetectorStack):
         res = 0.4
         super().__init__(mats, ferd.FixedEnergyResolutionDetector(res))
 
-    def generate_detector_response_to(
+    def generate_response_operator(
         self, spectrum: fs.FlareSpectrum, disperse_energy: bool,
         chosen_attenuations: tuple=ad.AttenuationType.ALL
-    ) -> np.ndarray:
-        prelim_resp = self._generate_material_response_due_to(spectrum, chosen_attenuations)
+    ) -> ro.ResponseOperator:
+        prelim_resp = self._generate_material_transmission(spectrum, chosen_attenuations)
         abzorbed = np.ones(spectrum.energy_edges.size - 1) -\
             self.detector.generate_overall_response_matrix_given(
                 spectrum, [ad.AttenuationType.PHOTOELECTRIC_ABSORPTION])
-        return self._dispatch_dispersion(spectrum, abzorbed * prelim_resp, disperse_energy)
+        return self._dispatch_dispersion(spectrum, ro.DiagonalResponse(abzorbed * prelim_resp), disperse_energy)
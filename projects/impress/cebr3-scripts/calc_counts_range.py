@@ -2,6 +2,7 @@ import os
 import sys
 import numpy as np
 from adetsim.hafx_src.HafxSimulationContainer import HafxSimulationContainer
+from adetsim.sim_src.ResponseLibrary import ResponseLibrary
 
 '''
 Computes the counts incident on the CeBr3 IMPRESS detectors given a lower and upper energy boud.
@@ -13,7 +14,6 @@ CEBR3_AREA = 43/4
 
 # Directory which contains pickled outputs
 opt_dir = sys.argv[1]
-filez = os.listdir(opt_dir)
 
 portion_sizes = [13, 33, 18, 38]
 base = '| '.join(f'{{:<{ps}}}' for ps in portion_sizes)
@@ -23,7 +23,11 @@ print('load containers')
 att_cps_cm2_d = dict()
 orig_cps_cm2_d = dict()
 thickness_dict = dict()
-containers = [HafxSimulationContainer.from_file(os.path.join(opt_dir, f)) for f in filez]
+if os.path.exists(os.path.join(opt_dir, ResponseLibrary.INDEX_NAME)):
+    # memory mapped; only the matrices used below get read
+    containers = HafxSimulationContainer.all_from_library(opt_dir)
+else:
+    containers = [HafxSimulationContainer.from_file(os.path.join(opt_dir, f)) for f in os.listdir(opt_dir)]
 containers.sort(key=lambda c: c.goes_class)
 print('done loading')
 
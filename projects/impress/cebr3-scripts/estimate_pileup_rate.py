@@ -4,6 +4,7 @@ import sys
 import scipy.integrate
 from adetsim.hafx_src.HafxSimulationContainer import HafxSimulationContainer
 from adetsim.hafx_src.HafxMaterialProperties import SINGLE_DET_AREA
+from adetsim.sim_src.ResponseLibrary import ResponseLibrary
 
 THRESHOLD_ENERGY = 10 # keV
 
@@ -16,11 +17,17 @@ def pileup_fraction_estimate(count_rate, pileup_time):
 
 optim_dir = sys.argv[1]
 pileup_time = 1 * 1e-6       # microsecond
-opt_files = os.listdir(optim_dir)
+if os.path.exists(os.path.join(optim_dir, ResponseLibrary.INDEX_NAME)):
+    # memory mapped; only the matrices used below get read
+    containers = HafxSimulationContainer.all_from_library(optim_dir)
+else:
+    containers = [
+        HafxSimulationContainer.from_saved_file(os.path.join(optim_dir, f))
+        for f in os.listdir(optim_dir)
+    ]
 
 loaded = dict()
-for f in opt_files:
-    con = HafxSimulationContainer.from_saved_file(os.path.join(optim_dir, f))
+for con in containers:
     loaded[con.flare_spectrum.goes_class] = con
 
 keyz = ('C1', 'C5', 'M1', 'M5', 'X1')